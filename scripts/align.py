@@ -0,0 +1,401 @@
+"""Time alignment of game trials with gaze and bioharness recordings
+
+Each cleaned MDP step of a trial (see `extract.extract_trial`) spans the
+time from its trial row to the row of the next step. Gaze samples
+recorded by `collect_eyetracker.py` are attached to the steps whose span
+contains them, and bioharness values recorded by `collect_bioharness.py`
+are joined as of the start of each step. All times are local wall clock
+times (see `clock.py`), and every join is a binary search over sorted
+times (see `timeindex.py`).
+
+The aligned columns of a mode are saved next to its trajectory store, in
+`<store>/aligned/<column>.npy`, with one row per step of the store, and
+are only loaded while the store has the episodes they were aligned with.
+
+Usage: python align.py --raw ../dataset/raw --out ../dataset/trajectories
+                       --gaze ../dataset/eyetracker --bio ../dataset/bioharness
+"""
+
+import os
+import re
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from process import TrialFeatures, NUM_MEDICAL_KITS
+from extract import MODES, TRIALS, trial_file, extract_trial
+from ingest import read_trial, ENGINE
+from gazelog import load_gaze, eye_means
+from aoi import kit_dwell, dwell_frame
+from timeindex import TimeIndex
+from store import TrajectoryStore
+
+
+# Maximum age of the bioharness value joined to a step
+BIO_TOLERANCE = np.timedelta64(5, "s")
+# Episode offsets of the store, saved with its aligned columns
+OFFSETS_FILE = "_episode_offsets"
+
+
+def read_game_times(file, column="Timestamp"):
+    """Wall clock time of each row of a trial CSV, as `datetime64[us]`"""
+    try:
+        times = pd.read_csv(file, usecols=[column], engine=ENGINE)[column]
+    except ValueError:
+        raise ValueError("{} has no time column {}".format(file, column))
+    return pd.to_datetime(times).to_numpy().astype("datetime64[us]")
+
+
+def gaze_recordings(folder, participant):
+    """Paths of a participant's gaze recordings, in session order
+
+    Recordings are segmented logs or JSON files named
+    `eyetrackerdata_<participant>-<n>` (see `collect_eyetracker.py`).
+    """
+    pattern = re.compile(re.escape("eyetrackerdata_" + participant)
+                         + r"-(\d+)(\.\d+\.jsonl)?$")
+    if not os.path.isdir(folder):
+        return []
+    sessions = {}
+    for fname in os.listdir(folder):
+        match = pattern.match(fname)
+        if match:
+            sessions[int(match.group(1))] = os.path.join(
+                folder, fname[:match.start(2)] if match.group(2) else fname)
+    return [sessions[n] for n in sorted(sessions)]
+
+
+def load_participant_gaze(folder, participant):
+    """`TimeIndex` of all gaze samples of a participant, or None if none"""
+    records = [load_gaze(path) for path in gaze_recordings(folder,
+                                                           participant)]
+    if not records:
+        return None
+    return TimeIndex(np.concatenate(records))
+
+
+def load_participant_bio(folder, participant):
+    """`TimeIndex` of a participant's bioharness CSV, or None if missing"""
+    file = os.path.join(folder, "zephyrdata_" + participant + ".csv")
+    if not os.path.exists(file):
+        return None
+    return TimeIndex(pd.read_csv(file, engine=ENGINE))
+
+
+class GazeSums():
+    """Cumulative sums of a gaze recording, to average any span of it
+
+    The gaze point of a sample is the mean of the valid eyes, and its
+    pupil diameter the mean of the valid pupils.
+    """
+    def __init__(self, records):
+        (x, y), count = eye_means(records, ("x", "y"))
+        (pupil,), pupil_count = eye_means(records, ("pupil",),
+                                          "pupil_validity")
+        valid, pupil_valid = count > 0, pupil_count > 0
+        self.sums = {name: _cumsum(values) for name, values in
+                     (("x", np.where(valid, x, 0.)),
+                      ("y", np.where(valid, y, 0.)),
+                      ("valid", valid.astype(np.float64)),
+                      ("pupil", np.where(pupil_valid, pupil, 0.)),
+                      ("pupil_valid", pupil_valid.astype(np.float64)))}
+
+    def mean(self, name, lo, hi, count):
+        total = self.sums[name][hi] - self.sums[name][lo]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(count > 0, total / count, np.nan)
+
+    def count(self, name, lo, hi):
+        return self.sums[name][hi] - self.sums[name][lo]
+
+
+def _cumsum(values):
+    return np.concatenate([[0.], np.cumsum(values)])
+
+
+def align_trial(times, rows, gaze=None, gaze_sums=None, bio=None,
+                bio_columns=None, tolerance=BIO_TOLERANCE):
+    """Attach gaze samples and bioharness values to the steps of a trial
+
+    Args:
+        times (np.ndarray): `datetime64[us]` time of each trial row.
+        rows (np.ndarray): trial row of each cleaned step.
+        gaze (TimeIndex): gaze samples of the participant, or None.
+        gaze_sums (GazeSums): cumulative sums of `gaze.data`, computed if
+                              not given.
+        bio (TimeIndex): bioharness values of the participant, or None.
+        bio_columns (list): bioharness columns to join. Defaults to every
+                            numeric column.
+        tolerance (np.timedelta64): maximum age of a joined bioharness
+                                    value. Older values are NaN.
+    Returns:
+        dict of columns with one entry per step:
+            time, end_time: span [time, end_time) of the step. Steps
+                            sharing a row have empty spans but the last.
+            row: trial row of the step.
+            gaze_start, gaze_stop: range of the step's samples in `gaze`,
+                            only meaningful with the same `gaze`.
+            gaze_count, gaze_x, gaze_y, pupil: number of samples with a
+                            valid gaze point, and mean gaze point (display
+                            area coordinates) and pupil diameter.
+            bio_<column>: last bioharness value at or before `time`.
+    """
+    start = times[rows]
+    # The last step lasts until the last row of the trial
+    end = np.append(start[1:], times[-1])
+    columns = {"time": start, "end_time": end, "row": rows}
+
+    if gaze is not None:
+        gaze_sums = GazeSums(gaze.data) if gaze_sums is None else gaze_sums
+        lo = gaze.locate(start)
+        hi = np.maximum(lo, gaze.locate(end))
+        count = gaze_sums.count("valid", lo, hi)
+        pupil_count = gaze_sums.count("pupil_valid", lo, hi)
+        columns.update({
+            "gaze_start": lo, "gaze_stop": hi,
+            "gaze_count": count.astype(np.int64),
+            "gaze_x": gaze_sums.mean("x", lo, hi, count),
+            "gaze_y": gaze_sums.mean("y", lo, hi, count),
+            "pupil": gaze_sums.mean("pupil", lo, hi, pupil_count),
+            })
+
+    if bio is not None:
+        if bio_columns is None:
+            # Columns of a recording without samples have no dtype
+            bio_columns = [column for column in bio.data.columns
+                           if column != bio.column and (
+                               len(bio) == 0 or
+                               pd.api.types.is_numeric_dtype(bio.data[column]))]
+        idxs = bio.locate(start, side="right") - 1
+        found = idxs >= 0
+        found[found] = start[found] - bio.times[idxs[found]] <= tolerance
+        for column in bio_columns:
+            values = np.full(len(start), np.nan)
+            values[found] = bio.data[column].to_numpy(
+                dtype=np.float64)[idxs[found]]
+            columns["bio_" + column] = values
+    return columns
+
+
+def align_participant(parent, user_folder, modes=MODES, gaze_dir=None,
+                      bio_dir=None, time_column="Timestamp", trials=TRIALS,
+                      binary_dir=None):
+    """Align every trial of a participant, for each extraction mode
+
+    Gaze and bioharness recordings are looked up in
+    `<gaze_dir>/<user_folder>/` and `<bio_dir>/<user_folder>/`, where the
+    collection scripts save them. Trials are read from their binary form
+    in `binary_dir` (see `ingest.read_trial`), and parsed once for all
+    modes.
+
+    Returns:
+        dict mapping each mode to the concatenated columns of the trials
+        (see `align_trial`), plus their `trial` number.
+    """
+    gaze = gaze_sums = bio = None
+    if gaze_dir is not None:
+        gaze = load_participant_gaze(os.path.join(gaze_dir, user_folder),
+                                     user_folder)
+        gaze_sums = None if gaze is None else GazeSums(gaze.data)
+    if bio_dir is not None:
+        bio = load_participant_bio(os.path.join(bio_dir, user_folder),
+                                   user_folder)
+
+    aligned = {mode: [] for mode in modes}
+    for trial in trials:
+        file = trial_file(parent, user_folder, trial)
+        features = TrialFeatures(read_trial(file, cache_dir=binary_dir))
+        times = read_game_times(file, time_column)
+        for mode, num_bins in modes.items():
+            rows = extract_trial(features, num_bins, return_rows=True)[-1]
+            columns = align_trial(times, rows, gaze, gaze_sums, bio)
+            columns["trial"] = np.full(len(rows), trial, dtype=np.int64)
+            aligned[mode].append(columns)
+    return {mode: {name: np.concatenate([columns[name]
+                                         for columns in trial_columns])
+                   for name in trial_columns[0]}
+            for mode, trial_columns in aligned.items()}
+
+
+def align_dataset(parent, traj_dir, modes=MODES, gaze_dir=None,
+                  bio_dir=None, time_column="Timestamp", binary_dir=None):
+    """Align every participant's trials and save the aligned columns
+
+    Participants are processed in the order of `extract.list_jobs`, and
+    the steps of each trial are checked against the episodes of the
+    store, so the rows of `<traj_dir>/<mode>/aligned` match the steps of
+    the store. Participants without some recording get missing values in
+    its columns (see `concat_aligned`). The `gaze_start` and `gaze_stop`
+    rows of each participant's gaze recording are not saved.
+
+    Raises:
+        ValueError if `parent` has no participant, or if the steps do not
+        match a store, e.g. one extracted before the cleaning changed.
+    """
+    user_folders = sorted(os.listdir(parent))
+    if not user_folders:
+        raise ValueError("No participant folders in {}".format(parent))
+
+    aligned = {mode: [] for mode in modes}
+    for user_folder in user_folders:
+        participant = align_participant(parent, user_folder, modes, gaze_dir,
+                                        bio_dir, time_column,
+                                        binary_dir=binary_dir)
+        for mode, columns in participant.items():
+            for name in ("gaze_start", "gaze_stop"):
+                columns.pop(name, None)
+            aligned[mode].append(columns)
+        print("Aligned", user_folder)
+
+    for mode in modes:
+        store = TrajectoryStore(os.path.join(traj_dir, mode))
+        _check_store(store, aligned[mode], user_folders)
+        save_aligned(os.path.join(store.path, "aligned"),
+                     concat_aligned(aligned[mode], user_folders),
+                     store["episode_offsets"])
+
+
+def _check_store(store, aligned, user_folders):
+    """Raise if the aligned steps do not match the episodes of a store"""
+    episodes = [(user_folder, int(trial), int(np.sum(columns["trial"]
+                                                     == trial)))
+                for user_folder, columns in zip(user_folders, aligned)
+                for trial in np.unique(columns["trial"])]
+    offsets = store["episode_offsets"]
+    stored = list(zip(map(str, store["episode_participants"]),
+                      map(int, store["episode_trials"]),
+                      map(int, np.diff(offsets))))
+    if episodes != stored:
+        raise ValueError("The steps of the trials do not match the store {},"
+                         " extract the trajectories again".format(store.path))
+
+
+def concat_aligned(aligned, user_folders):
+    """Concatenate the aligned columns of participants
+
+    Columns missing for some participants, e.g. without a bioharness
+    recording, are filled with NaN, or 0 for integer columns such as
+    `gaze_count`.
+
+    Args:
+        aligned (list): columns of each participant, see
+                        `align_participant`.
+        user_folders (list): participant of each entry of `aligned`.
+    """
+    names = []
+    for columns in aligned:
+        for name in columns:
+            if name not in names:
+                names.append(name)
+
+    concatenated = {}
+    for name in names:
+        example = next(columns[name] for columns in aligned
+                       if name in columns)
+        fill = 0 if example.dtype.kind in "iub" else np.nan
+        missing = [user_folder for user_folder, columns
+                   in zip(user_folders, aligned) if name not in columns]
+        if missing:
+            print("No", name, "for", ", ".join(missing))
+        concatenated[name] = np.concatenate([
+            columns[name] if name in columns else
+            np.full(len(columns["row"]), fill, dtype=example.dtype)
+            for columns in aligned])
+    return concatenated
+
+
+def trial_kit_dwell(parent, user_folder, gaze_dir, aoi_map,
+                    time_column="Timestamp", trials=TRIALS):
+    """Dwell time on each medical kit during each trial of a participant
+
+    Args:
+        parent (str): folder with one sub-folder of CSVs per participant.
+        user_folder (str): participant's sub-folder.
+        gaze_dir (str): folder with one sub-folder of eyetracker data per
+                        participant (see `load_participant_gaze`).
+        aoi_map (aoi.AOIMap): AOI lookup.
+        time_column (str): wall clock time column of the trial CSVs.
+    Returns:
+        DataFrame of seconds, see `aoi.dwell_frame`. It is NaN if the
+        participant has no gaze recording.
+    """
+    gaze = load_participant_gaze(os.path.join(gaze_dir, user_folder),
+                                 user_folder)
+    if gaze is None:
+        dwell = np.full([len(trials), NUM_MEDICAL_KITS], np.nan)
+        return dwell_frame(dwell, list(trials))
+    spans = np.array([read_game_times(trial_file(parent, user_folder, trial),
+                                      time_column)[[0, -1]]
+                      for trial in trials])
+    dwell = kit_dwell(gaze.data, aoi_map, spans[:, 0], spans[:, 1])
+    return dwell_frame(dwell, list(trials))
+
+
+def save_aligned(path, columns, episode_offsets):
+    """Save aligned columns as memory-mappable .npy files
+
+    The episode offsets of the store the columns were aligned with are
+    saved with them, as `_episode_offsets.npy`. Columns saved in `path`
+    by earlier runs are removed.
+
+    Args:
+        path (str): `aligned` folder of a trajectory store.
+        columns (dict): aligned columns, one row per step of the store.
+        episode_offsets (np.ndarray): episode offsets of the store.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for fname in os.listdir(path):
+        if fname.endswith(".npy") and fname[:-len(".npy")] not in columns:
+            os.remove(os.path.join(path, fname))
+    for name, array in columns.items():
+        np.save(os.path.join(path, name), array, allow_pickle=False)
+    np.save(os.path.join(path, OFFSETS_FILE), np.asarray(episode_offsets),
+            allow_pickle=False)
+
+
+def load_aligned(path, mmap_mode='r'):
+    """Load aligned columns saved by `save_aligned` as a DataFrame
+
+    Args:
+        path (str): `aligned` folder of a trajectory store.
+    Raises:
+        ValueError if the store was extracted again since the columns
+        were aligned, so its episodes changed.
+    """
+    offsets = os.path.join(path, OFFSETS_FILE + ".npy")
+    store = TrajectoryStore(os.path.dirname(os.path.normpath(path)))
+    if not os.path.exists(offsets) or not np.array_equal(
+            np.load(offsets, allow_pickle=False), store["episode_offsets"]):
+        raise ValueError("The aligned columns of {} do not match its "
+                         "episodes, run align.py again".format(store.path))
+    return pd.DataFrame({
+        os.path.splitext(fname)[0]: np.load(os.path.join(path, fname),
+                                            mmap_mode=mmap_mode,
+                                            allow_pickle=False)
+        for fname in sorted(os.listdir(path))
+        if fname.endswith(".npy") and not fname.startswith("_")})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--raw", type=str,
+                        default=os.path.join("..", "dataset", "raw"),
+                        help="Folder with one sub-folder of CSVs per participant")
+    parser.add_argument("--out", type=str,
+                        default=os.path.join("..", "dataset", "trajectories"),
+                        help="Folder of the trajectory stores")
+    parser.add_argument("--gaze", type=str, default=None,
+                        help="Folder with one sub-folder of eyetracker data per participant")
+    parser.add_argument("--bio", type=str, default=None,
+                        help="Folder with one sub-folder of bioharness data per participant")
+    parser.add_argument("--time_column", type=str, default="Timestamp",
+                        help="Wall clock time column of the trial CSVs")
+    parser.add_argument("--binary_dir", type=str, default=None,
+                        help="Folder of the binary copies of the trial CSVs "
+                             "(defaults to next to each CSV)")
+    opt = parser.parse_args()
+
+    align_dataset(opt.raw, opt.out, MODES, opt.gaze, opt.bio,
+                  opt.time_column, opt.binary_dir)
@@ -0,0 +1,143 @@
+"""Areas of interest (AOIs) of gaze points on the RW4T screen
+
+A `Calibration` tells where the SIDE_LEN x SIDE_LEN grid of the game and
+its UI panels are drawn, in the display area coordinates of the
+eyetracker ((0, 0) top left, (1, 1) bottom right). `AOIMap` rasterizes
+it once into a lookup image of AOI ids, so mapping gaze points to AOIs
+is a single indexing operation, whatever the number of samples.
+
+AOI ids are the flat grid offset `x * SIDE_LEN + y` for grid cells
+(like `process.MEDICAL_KIT_FLAT_IDX`), `SIDE_LEN ** 2 + i` for the i-th
+UI panel, and `OUTSIDE` for anything else, including invalid samples.
+"""
+
+import numpy as np
+import pandas as pd
+
+from process import SIDE_LEN, NUM_MEDICAL_KITS, MEDICAL_KIT_FLAT_IDX
+from gazelog import OUTSIDE, gaze_points
+
+
+NUM_CELLS = SIDE_LEN * SIDE_LEN
+# Longest gap between gaze samples counted as dwell time, in seconds
+MAX_GAP = 0.05
+
+
+class Calibration():
+    """Screen layout of the game, in display area coordinates
+
+    Args:
+        origin (tuple): display (x, y) of the grid corner at position
+                        (0, 0) of the game.
+        corner (tuple): display (x, y) of the opposite grid corner, at
+                        position (SIDE_LEN, SIDE_LEN).
+        transpose (bool): whether the game's x axis is drawn vertically.
+        panels (dict): display rectangle (left, top, right, bottom) of
+                       each UI panel, by name. Panels are drawn over
+                       the grid, in order.
+    """
+    def __init__(self, origin=(0., 0.), corner=(1., 1.), transpose=False,
+                 panels=None):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.corner = np.asarray(corner, dtype=np.float64)
+        self.transpose = transpose
+        self.panels = dict(panels or {})
+
+    def cells(self, x, y):
+        """Grid cell ids of display points, `OUTSIDE` off the grid"""
+        u = (x - self.origin[0]) / (self.corner[0] - self.origin[0])
+        v = (y - self.origin[1]) / (self.corner[1] - self.origin[1])
+        if self.transpose:
+            u, v = v, u
+        inside = (u >= 0) & (u < 1) & (v >= 0) & (v < 1)
+        grid_x = np.floor(np.where(inside, u, 0) * SIDE_LEN).astype(np.int64)
+        grid_y = np.floor(np.where(inside, v, 0) * SIDE_LEN).astype(np.int64)
+        return np.where(inside, grid_x * SIDE_LEN + grid_y, OUTSIDE)
+
+
+class AOIMap():
+    """Raster lookup of AOI ids over the display area
+
+    Args:
+        calibration (Calibration): screen layout.
+        resolution (int): side of the lookup raster, in pixels. Gaze
+                          points are snapped to its pixels.
+    """
+    def __init__(self, calibration, resolution=2048):
+        self.calibration = calibration
+        self.resolution = resolution
+        self.names = ["cell_{}_{}".format(*divmod(cell, SIDE_LEN))
+                      for cell in range(NUM_CELLS)] \
+            + list(calibration.panels)
+
+        # AOI of each pixel center, computed once
+        centers = (np.arange(resolution) + 0.5) / resolution
+        x, y = np.meshgrid(centers, centers)
+        raster = calibration.cells(x, y)
+        for idx, (left, top, right, bottom) in enumerate(
+                calibration.panels.values()):
+            raster[(x >= left) & (x < right) & (y >= top) & (y < bottom)] = \
+                NUM_CELLS + idx
+        self.raster = raster.astype(np.int16)
+
+        # Medical kit of each AOI id, shifted by one for `OUTSIDE`
+        self.kits = np.full(len(self.names) + 1, -1, dtype=np.int8)
+        self.kits[MEDICAL_KIT_FLAT_IDX + 1] = np.arange(NUM_MEDICAL_KITS)
+
+    def lookup(self, x, y):
+        """AOI ids of display points; NaN points are `OUTSIDE`"""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        valid = (x >= 0) & (x < 1) & (y >= 0) & (y < 1)
+        col = (np.where(valid, x, 0) * self.resolution).astype(np.int64)
+        row = (np.where(valid, y, 0) * self.resolution).astype(np.int64)
+        return np.where(valid, self.raster[row, col], OUTSIDE)
+
+    def kit_of(self, aois):
+        """Medical kit index of AOI ids, -1 if not a kit cell"""
+        return self.kits[np.asarray(aois) + 1]
+
+
+def sample_durations(times, max_gap=MAX_GAP):
+    """Seconds from each sample to the next, capped at `max_gap`
+
+    The last sample, and samples followed by a gap (e.g. a blink or a
+    pause of the recording), count for at most `max_gap`.
+    """
+    seconds = np.diff(times).astype("timedelta64[us]").astype(np.float64)
+    seconds = np.append(seconds / 1e6, max_gap)
+    return np.minimum(seconds, max_gap)
+
+
+def kit_dwell(records, aoi_map, starts, ends, max_gap=MAX_GAP):
+    """Dwell time on each medical kit cell within time windows
+
+    Args:
+        records (np.ndarray): gaze records sorted by `Timestamp`.
+        aoi_map (AOIMap): AOI lookup.
+        starts, ends (np.ndarray): `datetime64` limits of each window,
+                                   e.g. of each trial.
+    Returns:
+        np.ndarray of seconds, one row per window and one column per
+        medical kit, ordered by kit index.
+    """
+    times = records["Timestamp"]
+    kits = aoi_map.kit_of(aoi_map.lookup(*gaze_points(records)))
+    durations = sample_durations(times, max_gap)
+
+    # Cumulative dwell on each kit, so any window is a difference
+    dwell = np.zeros([len(records) + 1, NUM_MEDICAL_KITS])
+    on_kit = np.flatnonzero(kits >= 0)
+    dwell[on_kit + 1, kits[on_kit]] = durations[on_kit]
+    dwell = np.cumsum(dwell, axis=0)
+
+    lo = np.searchsorted(times, np.asarray(starts, dtype=times.dtype))
+    hi = np.searchsorted(times, np.asarray(ends, dtype=times.dtype))
+    return dwell[np.maximum(lo, hi)] - dwell[lo]
+
+
+def dwell_frame(dwell, trials):
+    """DataFrame of `kit_dwell` output, one row per trial"""
+    return pd.DataFrame(dwell, index=pd.Index(trials, name="trial"),
+                        columns=["kit_" + str(kit)
+                                 for kit in range(NUM_MEDICAL_KITS)])
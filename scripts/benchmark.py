@@ -0,0 +1,184 @@
+"""Benchmarks of the processing pipeline on synthetic trials
+
+Times `get_state`, `get_actions`, `get_rewards`, each stage of
+`clean_trajectory`, the extraction of a trial, and the extraction of a
+whole synthetic dataset from its CSVs (see `synth.py`), for several trial
+sizes. Each stage is run `--repeats` times and the fastest run is kept;
+the peak memory allocated by the stage is measured in an extra run with
+`tracemalloc`.
+
+Usage: python benchmark.py [--sizes 1000 10000 100000] [--json out.json]
+"""
+
+import io
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+from process import TrialFeatures, get_state, get_actions, get_rewards
+from clean import (transition_robot_pause, transition_robot_success,
+                   correct_simultaneous_moves, remove_waits)
+from extract import MODES, extract, extract_trial
+from synth import generate_trial, write_dataset
+
+
+def measure(func, repeats=3):
+    """Best wall time of `func()` over `repeats` runs, and its peak memory
+
+    Returns:
+        (seconds, peak bytes, output of the last run)
+    """
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak, out
+
+
+def benchmark_trial(num_rows, num_bins, seed=0, repeats=3, **kwargs):
+    """Benchmark the stages of a synthetic trial of `num_rows` frames"""
+    df = generate_trial(num_rows, seed, **kwargs)
+    states = get_state(df, num_bins)
+    actions = get_actions(df, num_bins)
+    rewards = get_rewards(df)
+
+    results = []
+
+    def record(stage, func, rows_in):
+        seconds, peak, out = measure(func, repeats)
+        rows_out = len(out[0]) if isinstance(out, tuple) else len(out)
+        results.append({"stage": stage, "rows": num_rows,
+                        "num_bins": num_bins, "rows_in": rows_in,
+                        "rows_out": rows_out, "seconds": seconds,
+                        "rows_per_second": rows_in / seconds,
+                        "peak_mib": peak / 2 ** 20})
+        return out
+
+    record("get_state", lambda: get_state(df, num_bins), num_rows)
+    record("get_actions", lambda: get_actions(df, num_bins), num_rows)
+    record("get_rewards", lambda: get_rewards(df), num_rows)
+
+    # Cleaning stages, each on the output of the previous one. Stages
+    # modify their inputs in place, so each run gets fresh copies.
+    arrays = states, actions
+    arrays = record("transition_robot_pause",
+                    lambda: transition_robot_pause(*_copies(arrays)),
+                    len(arrays[0]))
+    arrays = record("transition_robot_success",
+                    lambda: transition_robot_success(*_copies(arrays)),
+                    len(arrays[0]))
+    arrays = arrays + (rewards,)
+    arrays = record("correct_simultaneous_moves",
+                    lambda: correct_simultaneous_moves(*_copies(arrays)),
+                    len(arrays[0]))
+    record("remove_waits", lambda: remove_waits(*_copies(arrays)),
+           len(arrays[0]))
+
+    record("extract_trial",
+           lambda: extract_trial(TrialFeatures(df), num_bins), num_rows)
+    return results
+
+
+def _copies(arrays):
+    return tuple(array.copy() for array in arrays)
+
+
+def benchmark_dataset(num_rows, participants=2, seed=0, repeats=3,
+                      **kwargs):
+    """Benchmark `extract.extract` on a synthetic dataset
+
+    Cold runs ("extract_cold") parse the CSVs, warm runs
+    ("extract_warm") read the binary form saved by `ingest.read_trial`.
+    """
+    parent = tempfile.mkdtemp()
+    try:
+        files = write_dataset(parent, participants, num_rows, seed,
+                              **kwargs)
+        total = len(files) * num_rows
+
+        def run(cold):
+            if cold:
+                _remove_binaries(parent)
+            with contextlib.redirect_stdout(io.StringIO()):
+                return extract(parent, MODES)
+
+        results = []
+        for stage, cold in (("extract_cold", True), ("extract_warm", False)):
+            seconds, peak, _ = measure(lambda: run(cold), repeats)
+            results.append({"stage": stage, "rows": num_rows,
+                            "num_bins": None, "rows_in": total,
+                            "rows_out": None, "seconds": seconds,
+                            "rows_per_second": total / seconds,
+                            "peak_mib": peak / 2 ** 20})
+        return results
+    finally:
+        shutil.rmtree(parent)
+
+
+def _remove_binaries(parent):
+    for folder, _, fnames in os.walk(parent):
+        for fname in fnames:
+            if fname.endswith(".npz"):
+                os.remove(os.path.join(folder, fname))
+
+
+def run_benchmarks(sizes, modes=MODES, participants=2, repeats=3, seed=0,
+                   **kwargs):
+    """Benchmark every stage for each trial size and mode
+
+    Returns:
+        pd.DataFrame with one row per (size, mode, stage).
+    """
+    results = []
+    for num_rows in sizes:
+        for num_bins in modes.values():
+            results.extend(benchmark_trial(num_rows, num_bins, seed, repeats,
+                                           **kwargs))
+        results.extend(benchmark_dataset(num_rows, participants, seed,
+                                         repeats, **kwargs))
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000],
+                        help="Numbers of frames per trial")
+    parser.add_argument("--participants", type=int, default=2,
+                        help="Participants of the end-to-end benchmark")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Runs of each stage, the fastest is kept")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--respawn_frames", type=int, default=300,
+                        help="Mean frames before a rescued kit reappears")
+    parser.add_argument("--json", type=str, default=None,
+                        help="Save the results as JSON records")
+    parser.add_argument("--csv", type=str, default=None,
+                        help="Save the results as CSV")
+    opt = parser.parse_args()
+
+    results = run_benchmarks(opt.sizes, MODES, opt.participants, opt.repeats,
+                             opt.seed, respawn_frames=opt.respawn_frames)
+    with pd.option_context("display.max_rows", None, "display.width", 120):
+        print(results.to_string(index=False, float_format="{:.4g}".format))
+    if opt.json is not None:
+        with open(opt.json, "w") as f:
+            json.dump(results.to_dict(orient="records"), f, indent=2)
+    if opt.csv is not None:
+        results.to_csv(opt.csv, index=False)
@@ -0,0 +1,92 @@
+"""Content-hashed cache of extracted trial trajectories"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from clean import CLEAN_VERSION
+
+
+MANIFEST = "manifest.json"
+ARRAYS = ("states", "actions", "rewards", "dones")
+
+
+def file_hash(file, chunk_size=1 << 20):
+    """SHA-256 hex digest of a file's content"""
+    sha = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def shard_key(content_hash, num_bins):
+    """Key of a trial shard, given its CSV hash and processing parameters"""
+    bins = "continuous" if num_bins is None else "bins" + str(num_bins)
+    return "{}-{}-clean{}".format(content_hash, bins, CLEAN_VERSION)
+
+
+class TrialCache():
+    """Cache of cleaned per-trial trajectories.
+
+    Each shard stores the (states, actions, rewards, dones) arrays of one
+    trial in one mode, keyed on the trial CSV's content hash and the
+    processing parameters, so only new or changed trials are recomputed.
+    The manifest records the shards of every extracted trial, together
+    with the size and modification time its hash was computed for, so
+    unchanged CSVs are not hashed again. Shards and the manifest are
+    written atomically, so an interrupted run resumes where it stopped.
+    """
+    def __init__(self, directory):
+        self.dir = directory
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+
+        self.manifest_path = os.path.join(self.dir, MANIFEST)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"trials": {}}
+
+    def content_hash(self, file, name):
+        """Hash of a trial CSV, reused from the manifest if unchanged"""
+        stat = os.stat(file)
+        entry = self.manifest["trials"].get(name)
+        if (entry is not None and entry["size"] == stat.st_size
+                and entry["mtime_ns"] == stat.st_mtime_ns):
+            return entry["sha256"]
+        return file_hash(file)
+
+    def shard_path(self, key):
+        return os.path.join(self.dir, key + ".npz")
+
+    def load(self, key):
+        """Load a shard's arrays, or None if it is not cached"""
+        path = self.shard_path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as shard:
+            return tuple(shard[name] for name in ARRAYS)
+
+    def store(self, key, arrays):
+        """Store a shard's (states, actions, rewards, dones) arrays"""
+        tmp = self.shard_path(key + ".tmp")
+        np.savez(tmp, **dict(zip(ARRAYS, arrays)))
+        os.replace(tmp, self.shard_path(key))
+
+    def record(self, name, file, content_hash, keys):
+        """Record the shards of an extracted trial in the manifest"""
+        stat = os.stat(file)
+        self.manifest["trials"][name] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": content_hash,
+            "shards": keys,
+            }
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp, self.manifest_path)
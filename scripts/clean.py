@@ -1,15 +1,36 @@
 """Auxiliary code for processing Unity Data"""
 
 import numpy as np
-from copy import deepcopy as copy
 
+from process import (WAIT, COLLECT, STOP_ROBOT, TO_OBJ, action_kinds,
+                     make_actions, is_robot_dispatch)
+from instrument import stage
 
-def clean_trajectory(states, actions, rewards):
+
+# Version of the cleaning stages. Bump it whenever `clean_trajectory`
+# output changes, so cached trajectories are recomputed.
+CLEAN_VERSION = 4
+
+
+def clean_trajectory(states, actions, rewards, return_rows=False):
+    """Clean a trial's trajectory
+
+    If `return_rows` is True, also returns the index of the trial row
+    each cleaned step comes from. Robot dispatches split from a
+    simultaneous move (see `correct_simultaneous_moves`) come from the
+    row of that move.
+    """
+    rows = np.arange(len(states))
     states, actions = transition_robot_pause(states, actions)
     states, actions = transition_robot_success(states, actions)
-    states, actions, rewards = correct_simultaneous_moves(states, actions, rewards)
-    states, actions, rewards = remove_waits(states, actions, rewards)
-    return states, actions, rewards
+    states, actions, rewards, rows = _correct_simultaneous_moves(
+        states, actions, rewards, rows)
+    states, actions, rewards, rows = _remove_waits(states, actions, rewards,
+                                                   rows)
+    if not return_rows:
+        return states, actions, rewards
+    return states, actions, rewards, rows
+
 
 def correct_simultaneous_moves(states, actions, rewards):
     '''Separates simultaneous movements
@@ -20,6 +41,20 @@ def correct_simultaneous_moves(states, actions, rewards):
     actions are taken one at a time. 
     Correction will be done by first sending robot and then moving
     '''
+    rows = np.arange(len(states))
+    return _correct_simultaneous_moves(states, actions, rewards, rows)[:3]
+
+
+@stage("correct_simultaneous_moves")
+def _correct_simultaneous_moves(states, actions, rewards, rows):
+    """`correct_simultaneous_moves`, also tracking the row of each step"""
+    idxs = _simultaneous_moves(states)
+    states, actions, rewards = _separate_moves(states, actions, rewards, idxs)
+    return states, actions, rewards, np.insert(rows, idxs, rows[idxs])
+
+
+def _simultaneous_moves(states):
+    """Get indexes of steps moving the player and sending the robot"""
     # Find where 2d movements and robot usage are happening at same time
     x = states[:,0]
     y = states[:,1]
@@ -34,24 +69,27 @@ def correct_simultaneous_moves(states, actions, rewards):
     idxs_y = np.where(dy!=0)[0]
     idxs_r = np.where(dr!=0)[0]
     
-    idxs = np.concatenate(
-        [np.intersect1d(idxs_x, idxs_r),
-         np.intersect1d(idxs_y, idxs_r)]
-        )
-
-    # For each simultaneous movements at index, insert into actions
-    # an additional action of moving robot, and the action of moving.
-    for idx in idxs:
-        r_status = int(states[idx+1][-1])
-
-        insert_state = copy(states[idx])
-        insert_state[-1] = r_status
-        states = np.insert(states, idx + 1, insert_state, axis=0)
-        actions = np.insert(actions, idx, 'toObj' + str(r_status))
-        rewards = np.insert(rewards, idx, -1)
+    return np.union1d(np.intersect1d(idxs_x, idxs_r),
+                      np.intersect1d(idxs_y, idxs_r))
+
+
+def _separate_moves(states, actions, rewards, idxs):
+    # For each simultaneous movement at index, insert into actions
+    # an additional action of moving robot, before the action of moving.
+    # Insertion points refer to the original arrays, so all of them are
+    # inserted at once, in a single allocation per array.
+    r_status = states[idxs + 1, -1].astype(int)
+    insert_states = states[idxs]
+    insert_states[:, -1] = r_status
+    insert_actions = make_actions(TO_OBJ + r_status, actions.dtype)
+
+    states = np.insert(states, idxs + 1, insert_states, axis=0)
+    actions = np.insert(actions, idxs, insert_actions)
+    rewards = np.insert(rewards, idxs, -1)
     return states, actions, rewards
 
 
+@stage()
 def transition_robot_pause(states, actions):
     """If robot is paused, change robot status to idle (=-1)
     
@@ -59,49 +97,71 @@ def transition_robot_pause(states, actions):
     To distinguish states, we enforce pause by changing
     robot status to idle.
     """
-    idxs = np.where(actions == 'stop_robot')[0]
-    states[idxs + 1][:, -1] = -1
+    idxs = np.where(action_kinds(actions) == STOP_ROBOT)[0]
+    states[idxs + 1, -1] = -1
     return states, actions
 
 
+@stage()
 def transition_robot_success(states, actions):
-    """If robot picks an object, immediately change its status to idle"""
-    idxs = _robot_picks(states, actions)
-
-    
-    for idx in idxs:
-        for tmp in range(idx, len(states)):
-            states[tmp][-1] = -1
-            if 'toObj' in str(actions[tmp]):
-                break
+    """If robot picks an object, immediately change its status to idle
 
+    Robot status stays idle from each pick until the robot is sent to
+    an object again, including the step of that dispatch.
+    """
+    steps = np.arange(len(states))
+    picks = np.zeros(len(states), dtype=bool)
+    picks[_robot_picks(states, actions)] = True
+
+    # Latest pick at or before each step, and latest dispatch strictly
+    # before it (-1 if none)
+    last_pick = np.maximum.accumulate(np.where(picks, steps, -1))
+    last_dispatch = np.maximum.accumulate(
+        np.where(is_robot_dispatch(action_kinds(actions)), steps, -1))
+    last_dispatch = np.concatenate([[-1], last_dispatch])[:-1]
+
+    states[last_pick > last_dispatch, -1] = -1
     return states, actions
 
 
 def remove_waits(states, actions: np.array, rewards):
     " Only for discretized"
 
-    active_idx = np.where(actions != 'wait')[0]
+    rows = np.arange(len(states))
+    return _remove_waits(states, actions, rewards, rows)[:3]
+
+
+@stage("remove_waits")
+def _remove_waits(states, actions, rewards, rows):
+    """`remove_waits`, also tracking the row of each step"""
+    keep_idxs = _kept_steps(states, actions, rewards)
+    return states[keep_idxs], actions[keep_idxs], rewards[keep_idxs], \
+        rows[keep_idxs]
+
+
+def _kept_steps(states, actions, rewards):
+    """Get indexes of the steps kept by `remove_waits`"""
+    active_idx = np.where(action_kinds(actions) != WAIT)[0]
     wait_idx = _consecutive_robot_usage(actions)
     robot_picks_idx = _robot_picks(states, actions)
     positive_rewards = np.where(rewards>0)[0]
-    keep_idxs = np.concatenate([active_idx,
-                                wait_idx,
-                                robot_picks_idx,
-                                positive_rewards])
-    
-    return states[keep_idxs], actions[keep_idxs], rewards[keep_idxs]
+    # Keep steps in their original order, once each
+    return np.unique(np.concatenate([active_idx,
+                                     wait_idx,
+                                     robot_picks_idx,
+                                     positive_rewards]))
 
 
 def _consecutive_robot_usage(actions):
-    
-    wait_idx = np.where(actions != 'wait')[0]
-    active_actions = actions[wait_idx]
-    tmp = []
-    for idx in range(len(active_actions) - 1):
-        if 'toObj' in str(active_actions[idx]) and 'toObj' in str(active_actions[idx + 1]):
-            tmp.append(wait_idx[idx])
-    return np.array(tmp, dtype=int) + 1
+    """Get indexes after robot dispatches followed by another dispatch
+
+    Consecutive dispatches are looked up among non-wait actions.
+    """
+    active_idx = np.where(action_kinds(actions) != WAIT)[0]
+    dispatches = is_robot_dispatch(action_kinds(actions)[active_idx])
+    consecutive = dispatches[:-1] & dispatches[1:]
+    return active_idx[:-1][consecutive] + 1
+
 
 def _robot_picks(states, actions):
     """Get indexes when robot picks an object"""
@@ -109,5 +169,5 @@ def _robot_picks(states, actions):
     # Get where rescue status changes, and it's not due participant's
     # collection.
     idxs = np.where(np.any(rescue_status [1:] != rescue_status[:-1], axis=1))[0]
-    idxs = idxs[actions[idxs] != 'collect']
+    idxs = idxs[action_kinds(actions)[idxs] != COLLECT]
     return idxs
@@ -0,0 +1,119 @@
+"""Alignment of device clocks with the wall clock
+
+The eyetracker (`system_time_stamp`, microseconds) and the LSL streams of
+the bioharness (`pylsl.local_clock`, seconds) timestamp samples with
+monotonic clocks of their own. `ClockAligner` measures the offset of
+such a clock to the local wall clock, used in the game logs, and converts
+whole arrays of timestamps with one vectorized operation, so that all
+modalities share the same time base.
+"""
+
+import time
+import datetime
+
+import numpy as np
+
+
+# Naive local times are represented as microseconds since this epoch,
+# like `np.datetime64` does
+EPOCH = datetime.datetime(1970, 1, 1)
+UNITS = {"s": 10 ** 6, "ms": 10 ** 3, "us": 1}
+
+
+def wall_clock_us():
+    """Local wall clock time, in microseconds since `EPOCH`"""
+    return (datetime.datetime.now() - EPOCH) // datetime.timedelta(
+        microseconds=1)
+
+
+class ClockAligner():
+    """Conversion of device timestamps into local wall clock times
+
+    The offset between the two clocks is measured once when the aligner
+    is created and, if `resync_interval` is set, again by `maybe_resync`.
+    With several measurements, the offset is linearly interpolated
+    between them, which corrects the drift of the device clock.
+
+    Args:
+        clock (callable): current device time, e.g.
+                          `tobii_research.get_system_time_stamp` or
+                          `pylsl.local_clock`. None for an aligner built
+                          from recorded pairs (see `from_pairs`).
+        unit (str): unit of the device timestamps, "s", "ms" or "us".
+        resync_interval (float): seconds between offset measurements in
+                                 `maybe_resync`. Measured once if None.
+    """
+    def __init__(self, clock=None, unit="us", resync_interval=None):
+        self.clock = clock
+        self.scale = UNITS[unit]
+        self.resync_interval = resync_interval
+        # Device times and offsets to the wall clock, in microseconds
+        self.device_us = np.empty(0, dtype=np.int64)
+        self.offset_us = np.empty(0, dtype=np.int64)
+        self.last_sync = None
+        if clock is not None:
+            self.measure()
+
+    @classmethod
+    def from_pairs(cls, device, wall, unit="us"):
+        """Aligner from recorded (device time, wall clock time) pairs
+
+        Args:
+            device (array-like): device timestamps, in `unit`.
+            wall (array-like): wall clock times, as `np.datetime64`.
+        """
+        aligner = cls(unit=unit)
+        device_us = aligner._to_us(device)
+        wall_us = np.asarray(wall, dtype="datetime64[us]").astype(np.int64)
+        order = np.argsort(device_us, kind="stable")
+        aligner.device_us = device_us[order]
+        aligner.offset_us = wall_us[order] - device_us[order]
+        return aligner
+
+    def measure(self, repeats=5):
+        """Measure the current offset between the device and wall clocks
+
+        The wall clock is read around each device clock read, and the
+        read with the shortest round trip is kept.
+        """
+        best = None
+        for _ in range(repeats):
+            before = wall_clock_us()
+            device = self._to_us(self.clock())
+            after = wall_clock_us()
+            if best is None or after - before < best[0]:
+                best = (after - before, device, (before + after) // 2)
+        _, device, wall = best
+        self.device_us = np.append(self.device_us, device)
+        self.offset_us = np.append(self.offset_us, wall - device)
+        self.last_sync = time.monotonic()
+
+    def maybe_resync(self):
+        """Measure the offset again if `resync_interval` has elapsed"""
+        if (self.resync_interval is not None
+                and time.monotonic() - self.last_sync >= self.resync_interval):
+            self.measure()
+
+    def to_datetime(self, timestamps):
+        """Convert device timestamps into `datetime64[us]` wall clock times"""
+        if not len(self.device_us):
+            raise ValueError("The clock offset has not been measured")
+        device_us = self._to_us(timestamps)
+        if len(self.device_us) == 1:
+            offset = self.offset_us[0]
+        else:
+            # Constant offset before the first and after the last sync
+            offset = np.round(np.interp(device_us, self.device_us,
+                                        self.offset_us)).astype(np.int64)
+        return (device_us + offset).astype("datetime64[us]")
+
+    def to_strings(self, timestamps):
+        """Convert device timestamps into "YYYY-MM-DD HH:MM:SS.ffffff" """
+        wall = np.datetime_as_string(self.to_datetime(timestamps))
+        return np.char.replace(wall, "T", " ")
+
+    def _to_us(self, timestamps):
+        timestamps = np.asarray(timestamps)
+        if self.scale == 1 and timestamps.dtype.kind in "iu":
+            return timestamps.astype(np.int64)
+        return np.round(timestamps * self.scale).astype(np.int64)
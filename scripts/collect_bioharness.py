@@ -1,19 +1,31 @@
 import csv
-import datetime
 import argparse
 import os
+import queue
+import threading
+import time
 
 import pylsl
 from pylsl import StreamInlet, resolve_stream
 
+from clock import ClockAligner
+
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--person_ID", type=str, help="Person ID")
 parser.add_argument("--folder", type=str, help="Folder where zephyr data is saved")
+parser.add_argument("--stream", type=str, default="ZephyrSummary",
+                    help="Name of the LSL stream, e.g. ZephyrECG for waveforms")
+parser.add_argument("--chunked", action="store_true",
+                    help="Pull samples in chunks and write them from a background thread")
+parser.add_argument("--flush_interval", type=float, default=1.0,
+                    help="Seconds between flushes of the chunked writer")
+parser.add_argument("--resync_interval", type=float, default=None,
+                    help="Seconds between clock offset measurements (once if unset)")
 opt = parser.parse_args()
 
 class BioContainer():
-    def __init__(self, person_ID, directory=None):
+    def __init__(self, person_ID, directory=None, resync_interval=None):
         self.person_ID = person_ID
         # Directory where save data.
         self.dir = '.' if not directory else directory
@@ -25,7 +37,8 @@ class BioContainer():
         # avoid overwriting
         assert fname not in os.listdir(self.dir), 'File already exists'
 
-        self.last_reset = self._last_reset_time()
+        # Offset of the LSL clock to the wall clock
+        self.clock = ClockAligner(pylsl.local_clock, "s", resync_interval)
 
     def get_labels(self, info):
         labels = ["Timestamp"]
@@ -43,8 +56,8 @@ class BioContainer():
             writer = csv.writer(f)
             writer.writerow(self.labels)
 
-    def append_list_as_row(self, timestamp, sample, last_reset):
-        timestamp = self._converttime(timestamp, last_reset)
+    def append_list_as_row(self, timestamp, sample):
+        timestamp = self._converttime(timestamp)
         list_of_elem = [timestamp] + sample
         fname = 'zephyrdata_' + self.person_ID + '.csv'
         # Open file in append mode
@@ -55,40 +68,116 @@ class BioContainer():
             csv_writer.writerow(list_of_elem)
         return timestamp
 
-    def _converttime(self, timestamp, last_reset):
-        delta = datetime.timedelta(seconds=timestamp)
-        return last_reset + delta
+    def _converttime(self, timestamp):
+        return self.converttime_chunk([timestamp])[0]
+
+    def converttime_chunk(self, timestamps):
+        """Convert a chunk of LSL timestamps at once
+
+        Returns an array of "YYYY-MM-DD HH:MM:SS.ffffff" strings.
+        """
+        return self.clock.to_strings(timestamps)
+
+    def open_writer(self, flush_interval=1.0):
+        """Start a `ChunkWriter` appending to this container's CSV"""
+        fname = 'zephyrdata_' + self.person_ID + '.csv'
+        self.writer = ChunkWriter(self.dir + fname, flush_interval)
+        self.writer.start()
+        return self.writer
+
+    def append_chunk(self, timestamps, samples):
+        """Queue a chunk of samples for the background writer"""
+        timestamps = self.converttime_chunk(timestamps)
+        rows = [[timestamp] + sample
+                for timestamp, sample in zip(timestamps.tolist(), samples)]
+        self.writer.put(rows)
+        return timestamps
+
+
+class ChunkWriter(threading.Thread):
+    """Background writer of CSV rows
 
-    def _last_reset_time(self):
-        """Last reset time using LSL functions"""
-        # getting the library in which GetTickCount64() resides
-        seconds_transcurred = pylsl.local_clock()
-        now = datetime.datetime.now()
-        delta = datetime.timedelta(seconds=seconds_transcurred)
-        reset_day = now-delta
-        return reset_day
+    Keeps the file open and writes the chunks of rows queued by the
+    collector, flushing to disk at least every `flush_interval` seconds,
+    so the collector never waits on file I/O.
+    """
+    def __init__(self, path, flush_interval=1.0):
+        super().__init__(daemon=True)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.rows_written = 0
+
+    def put(self, rows):
+        self.queue.put(rows)
+
+    def stop(self):
+        """Write the queued rows, flush and close the file"""
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        with open(self.path, 'a+', newline='') as f:
+            csv_writer = csv.writer(f)
+            last_flush = time.monotonic()
+            while True:
+                timeout = max(0., last_flush + self.flush_interval
+                              - time.monotonic())
+                try:
+                    rows = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    rows = []
+                if rows is None:
+                    break
+                csv_writer.writerows(rows)
+                self.rows_written += len(rows)
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    f.flush()
+                    last_flush = time.monotonic()
 
 
 def main():
     # first resolve a bioharness stream on the lab network
     print("looking for a bioharness stream...")
-    streams = resolve_stream('name', 'ZephyrSummary')
+    streams = resolve_stream('name', opt.stream)
     # create a new inlet to read from the stream
     inlet = StreamInlet(streams[0])
     info = inlet.info()
     directory = opt.folder + opt.person_ID + '/'
-    dc = BioContainer(opt.person_ID, directory)
-    last_reset = dc._last_reset_time()
+    dc = BioContainer(opt.person_ID, directory, opt.resync_interval)
     dc.create_csv(info)
 
+    if opt.chunked:
+        collect_chunks(inlet, dc)
+        return
+
     while True:
         # get a new sample (you can also omit the timestamp part if you're not
         # interested in it)
         sample, timestamp = inlet.pull_sample()
-        timestamp = dc.append_list_as_row(timestamp, sample, last_reset)
+        dc.clock.maybe_resync()
+        timestamp = dc.append_list_as_row(timestamp, sample)
         print(timestamp, "HR", sample[2])
 
 
+def collect_chunks(inlet, dc, status_interval=5.0):
+    """Collect chunks of samples until interrupted"""
+    writer = dc.open_writer(opt.flush_interval)
+    last_status = time.monotonic()
+    try:
+        while True:
+            samples, timestamps = inlet.pull_chunk(timeout=1.0)
+            if timestamps:
+                dc.clock.maybe_resync()
+                timestamps = dc.append_chunk(timestamps, samples)
+            if time.monotonic() - last_status >= status_interval:
+                last_status = time.monotonic()
+                print(writer.rows_written, "samples written, last at",
+                      timestamps[-1] if len(timestamps) else None)
+    finally:
+        writer.stop()
+
+
 if __name__ == '__main__':
     try:
         main()
@@ -2,13 +2,16 @@
 
 import tobii_research as tr
 import time
-import datetime
-import ctypes
 import json
 import pandas as pd
-import numpy as np
 import os
 import argparse
+import threading
+
+from gazelog import (SampleBuffer, SegmentedLog, segment_paths, read_log,
+                     load_gaze, gaze_frame, to_records, gaze_points)
+from clock import ClockAligner
+from timeindex import TimeIndex
 
 
 parser = argparse.ArgumentParser()
@@ -20,8 +23,10 @@ opt = parser.parse_args()
 
 class GazeData():
     """Class that saves collected data of eyetracker."""
-    def __init__(self, person_ID, directory=None):
-        self.gaze_data = [] # list object to store collected data.
+    def __init__(self, person_ID, directory=None, buffer_size=600 * 60,
+                 resync_interval=60, aoi_map=None):
+        # Raw samples handed off by the SDK callback.
+        self.buffer = SampleBuffer(buffer_size)
         self.person_ID = person_ID # ID of list.
         # Directory where save data.
         self.dir = '.' if not directory else directory
@@ -34,6 +39,14 @@ class GazeData():
         self.counter = 1 # To count each eye tracking session
         fname = 'eyetrackerdata_' + self.person_ID + '-' + str(self.counter)
         assert fname not in os.listdir(self.dir), 'File already exists'
+        assert not segment_paths(self.dir + fname), 'File already exists'
+        self.log = None # Segmented log of the current session
+        self.samples_saved = 0 # Samples written to logs
+        self.last_sample = None # Last saved sample, for status reports
+        self.consumer = None # Thread saving queued samples
+        self.clock = None # Alignment of system_time_stamp with wall clock
+        self.index = None # Time index of the data read
+        self.aoi_map = aoi_map # AOI lookup (aoi.AOIMap), optional
         # Find eyetracker if class object is associated with person.
         if self.person_ID:
             found_eyetrackers = tr.find_all_eyetrackers()
@@ -46,6 +59,11 @@ class GazeData():
                   + self.eyetracker.device_name)
             print("Serial number: " + self.eyetracker.serial_number)
 
+            # Offset of the SDK clock, corrected for drift every
+            # `resync_interval` seconds while collecting
+            self.clock = ClockAligner(tr.get_system_time_stamp, "us",
+                                      resync_interval)
+
     def set_dir(self, folder:str):
         """Set folder where data will be stored.
         
@@ -56,32 +74,94 @@ class GazeData():
         """
         self.dir = folder
     
-    def collect_data(self):
-        """Turn on eye tracking."""
+    def collect_data(self, flush_interval=5, status_interval=1):
+        """Turn on eye tracking.
+
+        The SDK callback only queues raw samples. A consumer thread
+        timestamps them and appends them to the session log every
+        `flush_interval` seconds, so a crash loses at most that much
+        data, and prints a status line every `status_interval` seconds.
+        """
         self.tracking = True
+        self.consumer = threading.Thread(
+            target=self._consume, args=(flush_interval, status_interval),
+            daemon=True)
+        self.consumer.start()
         self.eyetracker.subscribe_to(tr.EYETRACKER_GAZE_DATA,
                                      self.__save_gaze_data,
                                      as_dictionary=True)
         while self.tracking:
-            time.sleep(5)
-            self.save_data()
+            time.sleep(status_interval)
 
     def stop_collection(self, save=True):
         """Turn off eye tracker and save collected data."""
         self.eyetracker.unsubscribe_from(tr.EYETRACKER_GAZE_DATA,
                                          self.__save_gaze_data)
+        self.tracking = False
+        if self.consumer is not None:
+            self.consumer.join()
+            self.consumer = None
         if save:
             self.save_data()
+        else:
+            self.buffer.drain()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
         
         # Count each collection of data.
         self.counter += 1
-        self.tracking = False
+
+    def _consume(self, flush_interval, status_interval):
+        """Consumer thread of the samples queued by the callback."""
+        last_flush = last_status = time.monotonic()
+        while self.tracking:
+            time.sleep(min(flush_interval, status_interval))
+            now = time.monotonic()
+            if now - last_flush >= flush_interval:
+                self.clock.maybe_resync()
+                self.save_data()
+                last_flush = now
+            if now - last_status >= status_interval:
+                self.print_status()
+                last_status = now
+
+    def print_status(self):
+        """Print the last saved gaze points and the sample counters."""
+        if self.last_sample is not None:
+            print("Left eye: ({gaze_left_eye}) \t Right eye: ({gaze_right_eye})".format(
+            gaze_left_eye=self.last_sample['left_gaze_point_on_display_area'],
+            gaze_right_eye=self.last_sample['right_gaze_point_on_display_area']))
+        print("Saved: {} \t Queued: {} \t Dropped: {}".format(
+            self.samples_saved, self.buffer.queued, self.buffer.dropped))
     
     def save_data(self):
-        fname = 'eyetrackerdata_' + self.person_ID + '-' + str(self.counter)
-        # data = self.converttime(self.gaze_data)
-        with open(self.dir + fname, 'w') as fout:
-            json.dump(self.gaze_data, fout, indent=2)
+        """Append the samples queued since the last call to the log.
+
+        The log of a session is split in segments
+        `eyetrackerdata_<id>-<counter>.<n>.jsonl` (see `gazelog`).
+        """
+        if self.log is None:
+            fname = 'eyetrackerdata_' + self.person_ID + '-' + str(self.counter)
+            self.log = SegmentedLog(self.dir + fname)
+        samples = self.buffer.drain()
+        if samples:
+            timestamps = self.clock.to_strings(
+                [sample['system_time_stamp'] for sample in samples])
+            for sample, timestamp in zip(samples, timestamps.tolist()):
+                sample['Timestamp'] = timestamp
+            if self.aoi_map is not None:
+                self.add_aoi(samples)
+        self.log.write(samples)
+        self.samples_saved += len(samples)
+        if samples:
+            self.last_sample = samples[-1]
+
+    def add_aoi(self, samples):
+        """Set the AOI id of each sample (see `aoi.AOIMap`)."""
+        aois = self.aoi_map.lookup(*gaze_points(to_records(samples)))
+        for sample, aoi in zip(samples, aois.tolist()):
+            sample['AOI'] = aoi
 
     def read_json(self, path:str):
         """Read json file.
@@ -95,66 +175,45 @@ class GazeData():
         self.data = pd.DataFrame.from_dict(data)
         return self.data
 
-    def converttime(self, data):
-        tmp = [d['system_time_stamp'] for d in data]
-        data['Timestamp'] = np.vectorize(self._converttime)(tmp)
-        return data
-
-    def _converttime(self, timestamp):
-        last_reset = self._last_reset_time()
-
-        microseconds = int(str(timestamp)[-6:])
-        seconds = int(str(timestamp)[:-6])
-
-        # extracting hours, minutes, seconds & days from t
-        # variable (which stores total time in seconds)
-        mins, seconds = divmod(seconds, 60)
-        hours, mins = divmod(mins, 60)
-        days, hours = divmod(hours, 24)
-        seconds = hours*3600 + mins*60 + seconds
-
-        delta = datetime.timedelta(days, seconds, microseconds)
-        timestamp_c = last_reset + delta
-
-        return timestamp_c
-
-    def _last_reset_time(self):
-        # getting the library in which GetTickCount64() resides
-        lib = ctypes.windll.kernel32
-        
-        # calling the function and storing the return value
-        t = lib.GetTickCount64()
-
-        # since the time is in milliseconds i.e. 1000 * seconds
-        # therefore truncating the value
-        microseconds = int(str(t)[-3:] + '000')
-        seconds = int(str(t)[:-3])
+    def read_log(self, base:str):
+        """Read a segmented log, given its path without segment suffix."""
+        self.data = pd.DataFrame.from_records(list(read_log(base)))
+        return self.data
 
-        # extracting hours, minutes, seconds & days from t
-        # variable (which stores total time in seconds)
-        mins, seconds = divmod(seconds, 60)
-        hours, mins = divmod(mins, 60)
-        days, hours = divmod(hours, 24)
+    def read_columns(self, path:str, cache=True):
+        """Read a recording as flat numeric columns (see `load_gaze`).
 
-        seconds = hours*3600 + mins*60 + seconds
+        `path` is a segmented log or a JSON file. Much faster than
+        `read_json` and `read_log`, whose gaze points are tuples.
+        """
+        self.data = gaze_frame(load_gaze(path, cache))
+        return self.data
 
-        delta = datetime.timedelta(days, seconds, microseconds)
-        timestamp = time.time()
+    def converttime(self, data, clock=None):
+        """Set the Timestamp column from the system_time_stamp column.
 
-        value = datetime.datetime.fromtimestamp(timestamp)
-        reset_day = value - delta
-        return reset_day
+        Params:
+            data (pd.DataFrame): gaze samples.
+            clock (ClockAligner): alignment of the SDK clock, defaults to
+                                  the one measured by this object.
+        """
+        clock = self.clock if clock is None else clock
+        data['Timestamp'] = clock.to_datetime(
+            data['system_time_stamp'].to_numpy())
+        return data
 
     def __save_gaze_data(self, gaze_data):
-        print("Left eye: ({gaze_left_eye}) \t Right eye: ({gaze_right_eye})".format(
-        gaze_left_eye=gaze_data['left_gaze_point_on_display_area'],
-        gaze_right_eye=gaze_data['right_gaze_point_on_display_area']))
-        now = time.time()
-        gaze_data['Timestamp'] = str(datetime.datetime.fromtimestamp(now))
+        """Tobii SDK callback: queue the sample.
 
-        # Add AOI
+        AOIs are added by the consumer thread (see `add_aoi`).
+        """
+        self.buffer.push(gaze_data)
 
-        self.gaze_data.append(gaze_data)
+    def time_index(self):
+        """Time index of the data read, sorted by Timestamp once."""
+        if self.index is None or self.index.data is not self.data:
+            self.index = TimeIndex(self.data, 'Timestamp')
+        return self.index
 
     def clean(self, start, end):
         """Remove data before start and after end time.
@@ -164,8 +223,17 @@ class GazeData():
             end (Timestamp)
         
         """
-        condition  = (self.data.Timestamp > start) & (self.data.Timestamp < end)
-        self.data = self.data[condition]
+        self.index = self.time_index().slice(start, end)
+        self.data = self.index.data
+
+    def windows(self, starts, ends):
+        """Data between each pair of start and end times, without copies.
+
+        Params:
+            starts (array of Timestamp)
+            ends (array of Timestamp)
+        """
+        return self.time_index().windows(starts, ends)
 
 
 if __name__=='__main__':
@@ -1,85 +1,303 @@
 """Code to get data in the (inverse) reinforcement learning paradigm"""
 
 import os
+import time
+import argparse
+import contextlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-import pandas as pd
 
-from process import get_state, get_actions, get_rewards
+from process import TrialFeatures
 from clean import clean_trajectory
+from cache import TrialCache, shard_key
+from store import save_trajectories, TrajectoryWriter
+from ingest import read_trial
+from instrument import Profiler, profile as profile_stages
+
+
+# Trials of each participant that are extracted
+TRIALS = range(3, 8)
+# Extraction modes and their number of bins (None for continuous)
+MODES = {"continuous": None, "discrete": 10}
+
+
+def trial_file(parent, user_folder, trial):
+    """Path of the raw CSV of a participant's trial"""
+    return os.path.join(parent, user_folder,
+                        user_folder + '-' + str(trial) + '.csv')
+
+
+def list_jobs(parent):
+    """List (user_folder, trial) pairs in extraction order"""
+    return [(user_folder, trial)
+            for user_folder in sorted(os.listdir(parent))
+            for trial in TRIALS]
+
+
+def extract_trial(features, num_bins=None, return_rows=False):
+    """Get cleaned states, actions, rewards and dones of a trial
+
+    If `return_rows` is True, also returns the trial row of each step
+    (see `clean_trajectory`).
+    """
+    states = features.state(num_bins)
+    actions = features.actions(num_bins)
+    rewards = features.rewards()
+    states, actions, rewards, rows = clean_trajectory(
+        states, actions, rewards, return_rows=True)
+
+    dones = np.zeros_like(actions, dtype=int)
+    dones[-1] = 1
+    if return_rows:
+        return states, actions, rewards, dones, rows
+    return states, actions, rewards, dones
+
+
+def extract_resolutions(df, bin_counts):
+    """Extract cleaned trajectories of a trial for several numbers of bins
+
+    The trial's columns, including continuous positions, are parsed
+    once (see `TrialFeatures`), so each resolution only adds binning
+    positions, building its actions and cleaning.
+
+    Args:
+        df (pd.DataFrame or TrialFeatures): a RW4T trial.
+        bin_counts (list): numbers of bins.
+    Returns:
+        dict mapping each number of bins to the cleaned (states, actions,
+        rewards, dones) arrays of the trial.
+    Raises:
+        ValueError if the player moves across more than one bin in a
+        frame at some resolution (see `get_2ddiscrete_actions`).
+    """
+    features = df if isinstance(df, TrialFeatures) else TrialFeatures(df)
+    return {num_bins: extract_trial(features, num_bins)
+            for num_bins in bin_counts}
+
+
+def sweep_modes(bin_counts):
+    """Extraction modes of a sweep over several numbers of bins"""
+    return {"discrete_" + str(num_bins): num_bins for num_bins in bin_counts}
+
+
+def _job_name(job):
+    user_folder, trial = job
+    return user_folder + '-' + str(trial)
+
+
+def _run_job(parent, job, modes, cache=None, profile=None,
+             binary_dir=None):
+    """Extract every mode of a single trial, timing the whole job
+
+    Modes whose shards are in `cache` are loaded instead of extracted,
+    and the CSV is only read if some mode is missing, from its binary
+    form in `binary_dir` (see `ingest.read_trial`). If `profile` is not
+    None, the stages of the job are recorded (see `instrument.py`), with
+    their memory peaks if it is True.
+    """
+    with contextlib.ExitStack() as stack:
+        profiler = None
+        if profile is not None:
+            profiler = stack.enter_context(profile_stages(profile))
+        results, elapsed, entry = _extract_job(parent, job, modes, cache,
+                                               profiler, binary_dir)
+    records = [] if profiler is None else profiler.records
+    return results, elapsed, entry, records
+
+
+def _extract_job(parent, job, modes, cache, profiler, binary_dir=None):
+    """Body of `_run_job`, labelling stages with the trial and mode"""
+    start = time.perf_counter()
+    file = trial_file(parent, *job)
+    results = {}
+    entry = None
+    if cache is not None:
+        content_hash = cache.content_hash(file, _job_name(job))
+        keys = {mode: shard_key(content_hash, num_bins)
+                for mode, num_bins in modes.items()}
+        entry = content_hash, keys
+        for mode, key in keys.items():
+            arrays = cache.load(key)
+            if arrays is not None:
+                results[mode] = arrays
+
+    features = None
+    for mode, num_bins in modes.items():
+        if mode in results:
+            continue
+        with contextlib.ExitStack() as stack:
+            if profiler is not None:
+                stack.enter_context(profiler.context(trial=_job_name(job),
+                                                     mode=mode))
+            if features is None:
+                features = TrialFeatures(read_trial(file,
+                                                    cache_dir=binary_dir))
+            results[mode] = extract_trial(features, num_bins)
+        if cache is not None:
+            cache.store(keys[mode], results[mode])
+
+    return results, time.perf_counter() - start, entry
+
+
+def iter_trials(parent, modes=MODES, workers=1, cache_dir=None,
+                profiler=None, binary_dir=None):
+    """Extract every participant's trials, yielding one trial at a time
+
+    Args:
+        parent (str): folder with one sub-folder of raw CSVs per
+                      participant.
+        modes (dict): extraction modes, mapping each mode name to its
+                      number of bins (None for continuous).
+        workers (int): number of worker processes. Trials are extracted
+                       serially in this process when it is 1.
+        cache_dir (str): optional folder of a `TrialCache`. Trials whose
+                         CSV and parameters are unchanged are loaded from
+                         it instead of extracted again.
+        profiler (instrument.Profiler): optional profiler collecting the
+                                        stages of every trial, including
+                                        those run by worker processes.
+        binary_dir (str): folder of the binary form of the trial CSVs
+                          (see `ingest.read_trial`). Defaults to the
+                          folders of the CSVs.
+    Yields:
+        (job, results) pairs in the order of `list_jobs`, where `job` is
+        (user_folder, trial) and `results` maps each mode to the trial's
+        cleaned (states, actions, rewards, dones) arrays.
+    """
+    jobs = list_jobs(parent)
+    cache = None if cache_dir is None else TrialCache(cache_dir)
+
+    profile = None if profiler is None else profiler.memory
+    outputs = _run_jobs(parent, jobs, modes, workers, cache, profile,
+                        binary_dir)
+    for job, (results, elapsed, entry, records) in zip(jobs, outputs):
+        print("Processed", job[0], "trial", job[1],
+              "in {:.2f}s".format(elapsed))
+        if profiler is not None:
+            profiler.records.extend(records)
+        if cache is not None:
+            cache.record(_job_name(job), trial_file(parent, *job), *entry)
+        yield job, results
+
+
+def _run_jobs(parent, jobs, modes, workers, cache, profile=None,
+              binary_dir=None):
+    """Run jobs serially or in a process pool, yielding outputs in order"""
+    if workers == 1:
+        for job in jobs:
+            yield _run_job(parent, job, modes, cache, profile, binary_dir)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Keep a bounded number of jobs in flight, so finished trials
+        # do not pile up in memory ahead of the consumer
+        pending = deque()
+        for job in jobs:
+            pending.append(
+                executor.submit(_run_job, parent, job, modes, cache,
+                                profile, binary_dir))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def extract(parent, modes=MODES, workers=1, cache_dir=None, profiler=None,
+            binary_dir=None):
+    """Extract MDP trajectories of every participant's trials
+
+    See `iter_trials` for the arguments.
+
+    Returns:
+        dict mapping each mode to its concatenated (states, actions,
+        rewards, dones) arrays. Trials are concatenated in the order of
+        `list_jobs`, so the output does not depend on `workers`.
+    """
+    trajectories = {mode: ([], [], [], []) for mode in modes}
+    for _, results in iter_trials(parent, modes, workers, cache_dir,
+                                  profiler, binary_dir):
+        for mode, arrays in results.items():
+            for mdp_list, array in zip(trajectories[mode], arrays):
+                mdp_list.append(array)
+
+    return {mode: tuple(np.concatenate(mdp_list) for mdp_list in lists)
+            for mode, lists in trajectories.items()}
+
+
+def extract_to_store(parent, traj_dir, modes=MODES, workers=1,
+                     cache_dir=None, profiler=None, binary_dir=None):
+    """Extract trajectories straight into trajectory stores
+
+    Trials are written to disk as they are extracted (see
+    `store.TrajectoryWriter`), so memory use is bounded by a few trials
+    rather than the whole dataset. See `iter_trials` for the arguments.
+    Stores are only replaced once every trial is extracted; if
+    extraction fails, the previous stores are left unchanged.
+    """
+    with contextlib.ExitStack() as stack:
+        writers = {mode: stack.enter_context(
+                       TrajectoryWriter(os.path.join(traj_dir, mode)))
+                   for mode in modes}
+        for (user_folder, trial), results in iter_trials(
+                parent, modes, workers, cache_dir, profiler, binary_dir):
+            for mode, arrays in results.items():
+                writers[mode].append(user_folder, trial, *arrays)
+
+
+def save(traj_dir, mode, jobs, states, actions, rewards, dones):
+    """Save extracted trajectories of a mode as a trajectory store"""
+    participants = [user_folder for user_folder, _ in jobs]
+    trials = [trial for _, trial in jobs]
+    save_trajectories(os.path.join(traj_dir, mode), states, actions,
+                      rewards, dones, participants, trials)
 
 
-# First continuous processing
-mdp_states = []
-mdp_actions = []
-mdp_rewards = []
-mdp_dones = []
-parent = "..\\dataset\\raw"
-traj_dir = "..\\dataset\\trajectories"
-
-for user_folder in os.listdir(parent):
-    print("Processing", user_folder)
-    path = os.path.join(parent, user_folder)
-    for trial in range(3, 8):
-        print("Trial number", trial)
-        file = os.path.join(path, user_folder + '-' + str(trial) + '.csv')
-        df = pd.read_csv(file)
-        states = get_state(df)
-        actions = get_actions(df)
-        rewards = get_rewards(df)
-        states, actions, rewards = clean_trajectory(states, actions, rewards)
-
-        dones = np.zeros_like(actions, dtype=int)
-        dones[-1] = 1
-        mdp_states.append(states)
-        mdp_actions.append(actions)
-        mdp_rewards.append(rewards)
-        mdp_dones.append(dones)
-
-mdp_states = np.concatenate(mdp_states)
-mdp_actions = np.concatenate(mdp_actions)
-mdp_rewards = np.concatenate(mdp_rewards)
-mdp_dones = np.concatenate(mdp_dones)
-
-
-np.save(os.path.join(traj_dir,"continuous\\states"), mdp_states, allow_pickle=False)
-np.save(os.path.join(traj_dir,"continuous\\actions"), mdp_actions)
-np.save(os.path.join(traj_dir,"continuous\\rewards"), mdp_rewards, allow_pickle=False)
-np.save(os.path.join(traj_dir,"continuous\\dones"), mdp_dones, allow_pickle=False)
-
-# Discrete processing
-
-mdp_states = []
-mdp_actions = []
-mdp_rewards = []
-mdp_dones = []
-
-for user_folder in os.listdir(parent):
-    print("Processing", user_folder)
-    path = os.path.join(parent, user_folder)
-    for trial in range(3, 8):
-        print("Trial number", trial)
-        file = os.path.join(path, user_folder + '-' + str(trial) + '.csv')
-        df = pd.read_csv(file)
-        states = get_state(df, num_bins=10)
-        actions = get_actions(df, num_bins=10)
-        rewards = get_rewards(df)
-        states, actions, rewards = clean_trajectory(states, actions, rewards)
-
-        dones = np.zeros_like(actions, dtype=int)
-        dones[-1] = 1
-        mdp_states.append(states)
-        mdp_actions.append(actions)
-        mdp_rewards.append(rewards)
-        mdp_dones.append(dones)
-
-
-mdp_states = np.concatenate(mdp_states)
-mdp_actions = np.concatenate(mdp_actions)
-mdp_rewards = np.concatenate(mdp_rewards)
-mdp_dones = np.concatenate(mdp_dones)
-
-np.save(os.path.join(traj_dir,"discrete\\states"), mdp_states, allow_pickle=False)
-np.save(os.path.join(traj_dir,"discrete\\actions"), mdp_actions)
-np.save(os.path.join(traj_dir,"discrete\\rewards"), mdp_rewards, allow_pickle=False)
-np.save(os.path.join(traj_dir,"discrete\\dones"), mdp_dones, allow_pickle=False)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--raw", type=str,
+                        default=os.path.join("..", "dataset", "raw"),
+                        help="Folder with the raw data of each participant")
+    parser.add_argument("--out", type=str,
+                        default=os.path.join("..", "dataset", "trajectories"),
+                        help="Folder where trajectories are saved")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="Folder of the per-trial cache (disabled if unset)")
+    parser.add_argument("--binary_dir", type=str, default=None,
+                        help="Folder of the binary copies of the trial CSVs "
+                             "(defaults to next to each CSV)")
+    parser.add_argument("--bins", type=int, nargs="+", default=None,
+                        help="Extract discrete trajectories for each of these "
+                             "numbers of bins, saved as `discrete_<bins>`, "
+                             "instead of the continuous and discrete modes")
+    parser.add_argument("--stream", action="store_true",
+                        help="Write each trial to disk as it is extracted, "
+                             "instead of concatenating all trials in memory")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Save the time spent in each stage of each "
+                             "trial to this .json or .csv file")
+    parser.add_argument("--profile_memory", action="store_true",
+                        help="Also profile the memory peak of each stage")
+    opt = parser.parse_args()
 
+    modes = MODES if opt.bins is None else sweep_modes(opt.bins)
+    profiler = None
+    if opt.profile is not None:
+        profiler = Profiler(opt.profile_memory)
+    if opt.stream:
+        extract_to_store(opt.raw, opt.out, modes=modes, workers=opt.workers,
+                         cache_dir=opt.cache, profiler=profiler,
+                         binary_dir=opt.binary_dir)
+    else:
+        trajectories = extract(opt.raw, modes=modes, workers=opt.workers,
+                               cache_dir=opt.cache, profiler=profiler,
+                               binary_dir=opt.binary_dir)
+        jobs = list_jobs(opt.raw)
+        for mode, arrays in trajectories.items():
+            save(opt.out, mode, jobs, *arrays)
+    if profiler is not None:
+        profiler.save(opt.profile)
+        print(profiler.summary())
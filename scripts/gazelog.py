@@ -0,0 +1,264 @@
+"""Append-only segmented logs of eyetracker gaze data
+
+Gaze samples are appended as JSON Lines to segment files named
+`<base>.<n>.jsonl`, with `n` counting from 0. Each flush only writes the
+samples gathered since the previous one, and a new segment is started
+before the current one would exceed a size limit.
+"""
+
+import os
+import re
+import json
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+
+class SampleBuffer():
+    """Bounded handoff of samples from one producer to one consumer
+
+    Backed by a `deque`, whose `append` and `popleft` are atomic, so
+    neither side takes a lock. When the buffer is full, new samples are
+    dropped and counted rather than blocking the producer.
+
+    Args:
+        maxlen (int): maximum number of queued samples.
+    """
+    def __init__(self, maxlen=600 * 60):
+        self.maxlen = maxlen
+        self.queue = deque()
+        # Each counter is only updated by one side
+        self.pushed = 0
+        self.dropped = 0
+        self.popped = 0
+
+    @property
+    def queued(self):
+        return len(self.queue)
+
+    def push(self, sample):
+        """Queue a sample (producer side). Returns False if dropped."""
+        if len(self.queue) >= self.maxlen:
+            self.dropped += 1
+            return False
+        self.queue.append(sample)
+        self.pushed += 1
+        return True
+
+    def drain(self):
+        """Pop every queued sample (consumer side)"""
+        samples = []
+        for _ in range(len(self.queue)):
+            samples.append(self.queue.popleft())
+        self.popped += len(samples)
+        return samples
+
+
+class SegmentedLog():
+    """Append-only JSON Lines log split into size-limited segments
+
+    Args:
+        base (str): path of the log without the segment suffix.
+        max_bytes (int): maximum size of a segment. A segment only
+                         exceeds it if a single line does.
+    """
+    def __init__(self, base, max_bytes=64 * 1024 * 1024):
+        self.base = base
+        self.max_bytes = max_bytes
+        # Continue after existing segments rather than overwrite them
+        self.segment = len(segment_paths(base))
+        self.f = None
+        self.size = 0
+
+    def write(self, samples):
+        """Append samples and flush them to disk
+
+        A new segment is started before any line that would take the
+        current one past `max_bytes`.
+        """
+        lines = []
+        for sample in samples:
+            # ASCII JSON, so one byte per character
+            line = json.dumps(sample) + "\n"
+            if self.f is None or (
+                    self.size > 0 and self.size + len(line) > self.max_bytes):
+                self._flush(lines)
+                lines = []
+                self._roll_over()
+            lines.append(line)
+            self.size += len(line)
+        self._flush(lines)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def _flush(self, lines):
+        if not lines:
+            return
+        self.f.write("".join(lines))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def _roll_over(self):
+        self.close()
+        self.f = open(segment_path(self.base, self.segment), "a")
+        self.size = self.f.tell()
+        self.segment += 1
+
+
+def segment_path(base, segment):
+    return "{}.{:03d}.jsonl".format(base, segment)
+
+
+def segment_paths(base):
+    """Existing segments of a log, in order"""
+    folder, name = os.path.split(base)
+    pattern = re.compile(re.escape(name) + r"\.(\d+)\.jsonl$")
+    segments = []
+    for fname in os.listdir(folder or "."):
+        match = pattern.match(fname)
+        if match:
+            segments.append((int(match.group(1)), os.path.join(folder, fname)))
+    return [path for _, path in sorted(segments)]
+
+
+def read_log(base):
+    """Read the samples of a segmented log, in order
+
+    A truncated last line, left by a crash during a flush, is skipped.
+    """
+    for path in segment_paths(base):
+        with open(path, "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                yield json.loads(line)
+
+
+# AOI id of samples outside every AOI, or recorded without AOIs (see
+# `aoi.py`)
+OUTSIDE = -1
+
+# Flat record of a gaze sample. Gaze points and pupil diameters are
+# float32, validities int8, timestamps int64 microseconds, which float32
+# could not hold exactly, and AOI ids int16.
+GAZE_DTYPE = np.dtype([
+    ("left_x", np.float32), ("left_y", np.float32),
+    ("right_x", np.float32), ("right_y", np.float32),
+    ("left_pupil", np.float32), ("right_pupil", np.float32),
+    ("left_validity", np.int8), ("right_validity", np.int8),
+    ("left_pupil_validity", np.int8), ("right_pupil_validity", np.int8),
+    ("device_time_stamp", np.int64), ("system_time_stamp", np.int64),
+    ("Timestamp", "datetime64[us]"), ("AOI", np.int16),
+    ])
+
+
+def load_gaze(path, cache=True, chunk_size=1 << 16):
+    """Load a gaze recording as flat numeric columns
+
+    Args:
+        path (str): segmented log (path without segment suffix, see
+                    `SegmentedLog`) or JSON file written by older
+                    versions of `collect_eyetracker.py`.
+        cache (bool): whether to read from (and save to) the binary form
+                      of the recording, `<path>.gaze.npy`. It is ignored
+                      if older than the recording, or saved with another
+                      `GAZE_DTYPE`.
+        chunk_size (int): number of records allocated at first. The
+                          allocation doubles whenever it is full.
+    Returns:
+        np.ndarray of `GAZE_DTYPE` records, memory mapped when read from
+        the binary form. See `gaze_frame` to get a DataFrame.
+    """
+    sources = segment_paths(path) or [path]
+    cache_path = path + ".gaze.npy"
+    if cache and os.path.exists(cache_path) and \
+            os.path.getmtime(cache_path) >= max(map(os.path.getmtime, sources)):
+        records = np.load(cache_path, mmap_mode="r", allow_pickle=False)
+        if records.dtype == GAZE_DTYPE:
+            return records
+
+    if segment_paths(path):
+        samples = read_log(path)
+    else:
+        with open(path, "r") as f:
+            samples = json.load(f)
+
+    records = np.empty(chunk_size, dtype=GAZE_DTYPE)
+    size = 0
+    for sample in samples:
+        if size == len(records):
+            # Doubling keeps the total copying linear in the recording
+            records = np.resize(records, max(2 * len(records), chunk_size))
+        records[size] = _flatten(sample)
+        size += 1
+    # Release the unused part of the allocation
+    records = records[:size].copy()
+
+    if cache:
+        tmp = cache_path[:-len(".npy")] + ".tmp.npy"
+        np.save(tmp, records, allow_pickle=False)
+        os.replace(tmp, cache_path)
+    return records
+
+
+def to_records(samples):
+    """`GAZE_DTYPE` records of a list of gaze samples"""
+    return np.array([_flatten(sample) for sample in samples],
+                    dtype=GAZE_DTYPE)
+
+
+def _flatten(sample):
+    left_x, left_y = sample["left_gaze_point_on_display_area"]
+    right_x, right_y = sample["right_gaze_point_on_display_area"]
+    return (left_x, left_y, right_x, right_y,
+            sample["left_pupil_diameter"], sample["right_pupil_diameter"],
+            sample["left_gaze_point_validity"],
+            sample["right_gaze_point_validity"],
+            sample["left_pupil_validity"], sample["right_pupil_validity"],
+            sample["device_time_stamp"], sample["system_time_stamp"],
+            # Wall clock time string, parsed into the datetime64 field
+            sample.get("Timestamp", "NaT"), sample.get("AOI", OUTSIDE))
+
+
+def gaze_frame(records):
+    """DataFrame of gaze records, one column per field"""
+    return pd.DataFrame({name: records[name] for name in records.dtype.names})
+
+
+def eye_means(records, names, validity="validity"):
+    """Per-sample means of the left and right eye fields over valid eyes
+
+    Args:
+        records (np.ndarray): records of `GAZE_DTYPE`.
+        names (list): fields to average, without the eye prefix (e.g.
+                      "x" for `left_x` and `right_x`).
+        validity (str): validity field of the eyes, without the prefix.
+    Returns:
+        list of float64 means, NaN where no eye is valid, and the number
+        of valid eyes of each sample.
+    """
+    valid = np.stack([records["left_" + validity] == 1,
+                      records["right_" + validity] == 1])
+    count = valid.sum(axis=0)
+    means = []
+    for name in names:
+        values = np.stack([records["left_" + name],
+                           records["right_" + name]]).astype(np.float64)
+        total = np.where(valid, values, 0.).sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means.append(np.where(count > 0, total / count, np.nan))
+    return means, count
+
+
+def gaze_points(records):
+    """Display point of gaze records, the mean of the valid eyes
+
+    Returns:
+        x, y arrays, NaN where no eye is valid.
+    """
+    (x, y), _ = eye_means(records, ("x", "y"))
+    return x, y
@@ -0,0 +1,126 @@
+"""Ingestion of raw RW4T trial CSVs
+
+Only the columns used by `process.py` are read, with explicit dtypes.
+After the first read, each trial is persisted next to its CSV (or in a
+chosen folder) in a compact .npz form, from which later reads are served
+without parsing the CSV again. String columns are stored dictionary
+encoded, which is compact since most of them (e.g. `GridRep`) take few
+distinct values per trial.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+    ENGINE = "pyarrow"
+except ImportError:
+    ENGINE = "c"
+
+from instrument import stage
+
+
+# Columns used by `process.py`, and their dtypes
+STR_COLUMNS = ["GridRep", "RobotState", "PlayerUnityPos", "ButtonsClicked",
+               "DangerView"]
+INT_COLUMNS = ["PlayerNum", "RobotNum"]
+COLUMNS = STR_COLUMNS + INT_COLUMNS
+DTYPES = {**{column: str for column in STR_COLUMNS},
+          **{column: np.int64 for column in INT_COLUMNS}}
+
+
+@stage()
+def read_trial(file, cache=True, cache_dir=None):
+    """Read the columns of a RW4T trial used by `process.py`
+
+    Args:
+        file (str): path of the trial CSV.
+        cache (bool): whether to read from (and save to) the binary form
+                      of the trial. The binary form is ignored when the
+                      CSV was modified after it was saved.
+        cache_dir (str): folder of the binary form. Defaults to the
+                         folder of the CSV. The CSV is read as is if the
+                         binary form cannot be saved there.
+    Returns:
+        pd.DataFrame with the `COLUMNS` of the trial. Missing strings
+        (e.g. frames without clicked buttons) are empty strings.
+    """
+    if not cache:
+        return read_csv(file)
+
+    path = binary_path(file, cache_dir)
+    stat = os.stat(file)
+    source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    if os.path.exists(path):
+        df = load_columns(path, source)
+        if df is not None:
+            return df
+
+    df = read_csv(file)
+    try:
+        save_columns(df, path, source)
+    except OSError:
+        # e.g. a read-only copy of the dataset: the CSV is parsed again
+        # next time
+        pass
+    return df
+
+
+def read_csv(file):
+    """Parse the `COLUMNS` of a trial CSV"""
+    df = pd.read_csv(file, usecols=COLUMNS, dtype=DTYPES, engine=ENGINE)
+    df[STR_COLUMNS] = df[STR_COLUMNS].fillna("")
+    return df[COLUMNS]
+
+
+def binary_path(file, cache_dir=None):
+    """Path of the binary form of a trial CSV"""
+    folder, name = os.path.split(file)
+    folder = folder if cache_dir is None else cache_dir
+    return os.path.join(folder, os.path.splitext(name)[0] + ".npz")
+
+
+def save_columns(df, path, source):
+    """Save trial columns in binary form
+
+    Args:
+        df (pd.DataFrame): trial as returned by `read_csv`.
+        path (str): path of the .npz file.
+        source (np.ndarray): size and modification time of the CSV.
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    arrays = {"_source": source}
+    for column in STR_COLUMNS:
+        codes, uniques = pd.factorize(df[column])
+        arrays[column + ".codes"] = codes.astype(np.int32)
+        arrays[column + ".values"] = np.asarray(uniques, dtype=str)
+    for column in INT_COLUMNS:
+        arrays[column] = df[column].to_numpy(dtype=np.int64)
+
+    tmp = path[:-len(".npz")] + ".tmp.npz"
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+def load_columns(path, source=None):
+    """Load trial columns saved by `save_columns`
+
+    Returns None if `source` is given and does not match the size and
+    modification time of the CSV the binary form was saved from.
+    """
+    with np.load(path, allow_pickle=False) as arrays:
+        if source is not None and not np.array_equal(arrays["_source"],
+                                                      source):
+            return None
+        columns = {}
+        for column in STR_COLUMNS:
+            values = arrays[column + ".values"].astype(object)
+            columns[column] = values[arrays[column + ".codes"]]
+        for column in INT_COLUMNS:
+            columns[column] = arrays[column]
+    return pd.DataFrame(columns)[COLUMNS]
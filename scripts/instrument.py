@@ -0,0 +1,164 @@
+"""Optional per-stage instrumentation of the processing pipeline
+
+Functions decorated with `stage` record their wall time, the number of
+rows they take and return, and optionally their peak memory allocation,
+while a `Profiler` is enabled. When none is, a stage only costs a global
+lookup on top of the function call.
+
+    with profile(memory=True) as profiler:
+        with profiler.context(trial="P01-3"):
+            extract_trial(features, 10)
+    profiler.save("profile.json")
+"""
+
+import json
+import time
+import functools
+import contextlib
+import tracemalloc
+
+import pandas as pd
+
+
+# Enabled profiler, None when instrumentation is disabled
+_profiler = None
+
+
+def stage(name=None):
+    """Decorator recording calls of a function as a pipeline stage
+
+    Args:
+        name (str): name of the stage, defaults to the function's name.
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            return _profiler.run(stage_name, func, args, kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiler():
+    """Records of the stages run while enabled
+
+    Args:
+        memory (bool): whether to measure the peak memory allocated by
+                       each stage with `tracemalloc`, which slows stages
+                       down.
+    """
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.records = []
+        self.labels = {}
+        # Highest memory use seen by each running stage in its nested
+        # stages, which reset the `tracemalloc` peak
+        self._peaks = []
+
+    @contextlib.contextmanager
+    def context(self, **labels):
+        """Add labels (e.g. trial, mode) to the records of a block"""
+        previous = self.labels
+        self.labels = {**previous, **labels}
+        try:
+            yield self
+        finally:
+            self.labels = previous
+
+    def run(self, name, func, args, kwargs):
+        """Run a stage and record it"""
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            tracemalloc.reset_peak()
+        self._peaks.append(0)
+        start = time.perf_counter()
+        try:
+            out = func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            nested_peak = self._peaks.pop()
+
+        record = {**self.labels, "stage": name, "seconds": seconds,
+                  "rows_in": _num_rows(args[0]) if args else None,
+                  "rows_out": _num_rows(out)}
+        if self.memory:
+            peak = max(tracemalloc.get_traced_memory()[1], nested_peak)
+            record["peak_bytes"] = peak - current
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+        self.records.append(record)
+        return out
+
+    def frame(self):
+        """DataFrame of the records, one row per stage call"""
+        return pd.DataFrame(self.records)
+
+    def summary(self):
+        """Totals of each stage over all calls"""
+        df = self.frame()
+        if df.empty:
+            return df
+        aggregations = {"calls": ("seconds", "size"),
+                        "seconds": ("seconds", "sum"),
+                        "max_seconds": ("seconds", "max"),
+                        "rows_in": ("rows_in", "sum"),
+                        "rows_out": ("rows_out", "sum")}
+        if "peak_bytes" in df:
+            aggregations["max_peak_bytes"] = ("peak_bytes", "max")
+        return df.groupby("stage", sort=False).agg(**aggregations) \
+            .sort_values("seconds", ascending=False)
+
+    def save(self, path):
+        """Save the records, as JSON (with a summary) or CSV
+
+        The format follows the extension of `path`.
+        """
+        if path.endswith(".csv"):
+            self.frame().to_csv(path, index=False)
+            return
+        summary = self.summary().reset_index()
+        with open(path, "w") as f:
+            json.dump({"records": self.records,
+                       "summary": summary.to_dict(orient="records")},
+                      f, indent=2, default=_to_json)
+
+
+def _num_rows(value):
+    """Rows of an array or data frame, or of the first of a tuple"""
+    if isinstance(value, tuple):
+        value = value[0] if value else None
+    shape = getattr(value, "shape", None)
+    return shape[0] if shape else None
+
+
+def _to_json(value):
+    # numpy scalars of the summary
+    return value.item()
+
+
+@contextlib.contextmanager
+def profile(memory=False):
+    """Enable a profiler within a block, restoring the previous one"""
+    global _profiler
+    previous = _profiler
+    was_tracing = tracemalloc.is_tracing()
+    profiler = Profiler(memory)
+    _profiler = profiler
+    if memory and not was_tracing:
+        tracemalloc.start()
+    try:
+        yield profiler
+    finally:
+        _profiler = previous
+        if memory and not was_tracing:
+            tracemalloc.stop()
+
+
+def active():
+    """Enabled profiler, or None"""
+    return _profiler
@@ -0,0 +1,356 @@
+"""Live processing of RW4T trials while the game is running
+
+`LiveTrial` turns the rows of a Unity DataLog CSV into cleaned MDP
+transitions as they are appended. It mirrors `get_state`, `get_actions`,
+`get_rewards` and `clean_trajectory` run on the whole trial. Each stage
+keeps only the few previous rows it depends on, so the cost of a row
+does not grow with the length of the trial.
+
+Usage: python live.py path/to/trial.csv [--bins 10] [--replay --rate 30]
+"""
+
+import csv
+import math
+import time
+import bisect
+import argparse
+from collections import namedtuple, deque
+
+import numpy as np
+
+from process import (SIDE_LEN, MEDICAL_KIT_FLAT_IDX, NEAREST_KIT,
+                     STEP_ACTIONS, WAIT, MOVE, COLLECT, STOP_ROBOT, TO_OBJ)
+
+
+# `angle` is the angle of continuous `MOVE` actions, NaN otherwise
+Transition = namedtuple("Transition", ["state", "action", "angle", "reward"])
+
+# Step of the trajectory flowing through the stages. `state` is a tuple
+# (x, y, six kit flags, robot status).
+_Step = namedtuple("_Step", ["state", "action", "angle", "reward", "pick"])
+
+
+class LiveTrial():
+    """Incremental MDP processing of a RW4T trial
+
+    Feed the rows of a trial, in order, to `push`, then call `finish` once
+    the trial ends. Both return the cleaned transitions that became
+    known, so that the concatenation of all of them equals the output of
+    `clean_trajectory` on the whole trial. A transition is emitted once
+    the next rows it depends on have arrived, usually one or two rows
+    later.
+
+    Args:
+        num_bins (int): number of bins of discrete positions, or None for
+                        continuous positions and actions.
+    """
+    def __init__(self, num_bins=None):
+        self.stages = [_RawStage(num_bins), _RobotStatusStage(),
+                       _SimultaneousMovesStage(), _RemoveWaitsStage()]
+
+    def push(self, row):
+        """Process a row, given as a mapping of column names to strings"""
+        return self._feed([row], final=False)
+
+    def finish(self):
+        """Flush the transitions held back at the end of the trial"""
+        return self._feed([], final=True)
+
+    def _feed(self, items, final):
+        for stage in self.stages:
+            out = []
+            for item in items:
+                out.extend(stage.push(item))
+            if final:
+                out.extend(stage.finish())
+            items = out
+        return [Transition(np.array(step.state), step.action, step.angle,
+                           step.reward)
+                for step in items]
+
+
+class _RawStage():
+    """States, actions and rewards of each row (see `TrialFeatures`)
+
+    The action of a row depends on the next row, so each step is emitted
+    when the following row arrives.
+    """
+    def __init__(self, num_bins):
+        self.num_bins = num_bins
+        if num_bins is not None:
+            self.bins = list(np.linspace(0, 80, num_bins + 1))
+        self.prev = None
+        self._grid = None
+        self._rescue = None
+        self._robot = {}
+
+    def push(self, row):
+        current = self._parse(row)
+        out = []
+        if self.prev is not None:
+            out.append(self._step(self.prev, current, row["ButtonsClicked"]))
+        self.prev = current
+        return out
+
+    def finish(self):
+        if self.prev is None:
+            return []
+        # Last action is a wait
+        prev, self.prev = self.prev, None
+        return [_Step(prev["state"], WAIT, math.nan, prev["reward"], False)]
+
+    def _step(self, prev, current, click):
+        state, next_state = prev["state"], current["state"]
+        dx = next_state[0] - state[0]
+        dy = next_state[1] - state[1]
+        angle = math.nan
+        if self.num_bins is None:
+            action = WAIT
+            if abs(dx) + abs(dy) != 0:
+                action = MOVE
+                # Same rounding as the vectorized `get_2dcontinuous_actions`
+                angle = float(np.arctan2(dy, dx))
+        else:
+            dx, dy = int(dx), int(dy)
+            if abs(dx) > 1 or abs(dy) > 1 or STEP_ACTIONS[dx + 1, dy + 1] < 0:
+                raise ValueError("Unexpected discrete step")
+            action = int(STEP_ACTIONS[dx + 1, dy + 1])
+
+        rescued = state[2:-1] != next_state[2:-1]
+        if rescued and click == "CollectButton":
+            action, angle = COLLECT, math.nan
+        robot, next_robot = state[-1], next_state[-1]
+        if robot != next_robot:
+            if click == "MoveButton" and next_robot >= 0:
+                action, angle = TO_OBJ + int(next_robot), math.nan
+            elif click == "PauseButton":
+                action, angle = STOP_ROBOT, math.nan
+
+        pick = rescued and action != COLLECT
+        return _Step(state, action, angle, prev["reward"], pick)
+
+    def _parse(self, row):
+        grid = row["GridRep"]
+        if grid != self._grid:
+            # The grid only changes when a kit is delivered
+            cells = grid.split("_")
+            self._grid = grid
+            self._rescue = tuple(float(cells[idx] == "9")
+                                 for idx in MEDICAL_KIT_FLAT_IDX)
+
+        status = row["RobotState"]
+        if status not in self._robot:
+            robot = -1.
+            if status != "Stopped":
+                x, y = (min(max(int(c), 0), SIDE_LEN - 1)
+                        for c in status.split("_"))
+                robot = float(NEAREST_KIT[x, y])
+            self._robot[status] = robot
+
+        y, _, x = row["PlayerUnityPos"].split("_")
+        x = 12 - float(x)
+        y = float(y) + 4
+        if self.num_bins is not None:
+            x = float(bisect.bisect_right(self.bins, x) - 1)
+            y = float(bisect.bisect_right(self.bins, y) - 1)
+
+        player_num = int(row["PlayerNum"])
+        robot_num = int(row["RobotNum"])
+        reward = -1. - 10 * (row["DangerView"] == "active")
+        if self.prev is not None:
+            reward += 25 * (player_num - self.prev["player_num"] == 1)
+            reward += 25 * (robot_num - self.prev["robot_num"] == 1)
+
+        return {"state": (x, y) + self._rescue + (self._robot[status],),
+                "reward": float(reward), "player_num": player_num,
+                "robot_num": robot_num}
+
+
+class _RobotStatusStage():
+    """`transition_robot_pause` and `transition_robot_success`"""
+    def __init__(self):
+        self.step = 0
+        self.last_pick = -1
+        self.last_dispatch = -1
+        self.paused = False
+
+    def push(self, item):
+        idle = self.paused
+        if item.pick:
+            self.last_pick = self.step
+        if self.last_pick > self.last_dispatch:
+            idle = True
+        if item.action >= TO_OBJ:
+            self.last_dispatch = self.step
+        self.paused = item.action == STOP_ROBOT
+        self.step += 1
+
+        if idle:
+            item = item._replace(state=item.state[:-1] + (-1.,))
+        return [item]
+
+    def finish(self):
+        return []
+
+
+class _SimultaneousMovesStage():
+    """`correct_simultaneous_moves`, which needs the next state"""
+    def __init__(self):
+        self.prev = None
+
+    def push(self, item):
+        prev, self.prev = self.prev, item
+        if prev is None:
+            return []
+
+        moved = (prev.state[0] != item.state[0]
+                 or prev.state[1] != item.state[1])
+        robot = item.state[-1]
+        if not (moved and robot > prev.state[-1]):
+            return [prev]
+        dispatch = _Step(prev.state, TO_OBJ + int(robot), math.nan, -1., False)
+        return [dispatch,
+                prev._replace(state=prev.state[:-1] + (robot,))]
+
+    def finish(self):
+        prev, self.prev = self.prev, None
+        return [] if prev is None else [prev]
+
+
+class _RemoveWaitsStage():
+    """`remove_waits`
+
+    A wait right after a robot dispatch is only kept if the next non-wait
+    action is another dispatch, so it is held back, together with the
+    kept steps that follow it, until that action arrives.
+    """
+    def __init__(self):
+        self.prev = None
+        self.prev_dispatch = False
+        # Kept steps and the held back wait, as [step, keep] pairs
+        self.queue = deque()
+        self.pending = None
+
+    def push(self, item):
+        prev, self.prev = self.prev, item
+        if prev is None:
+            return []
+        pick = prev.state[2:-1] != item.state[2:-1] \
+            and prev.action != COLLECT
+        return self._process(prev, pick)
+
+    def finish(self):
+        out = []
+        if self.prev is not None:
+            out = self._process(self.prev, False)
+            self.prev = None
+        # A held back wait without a following dispatch is dropped
+        if self.pending is not None:
+            self.queue.remove(self.pending)
+            self.pending = None
+        out.extend(step for step, _ in self.queue)
+        self.queue.clear()
+        return out
+
+    def _process(self, step, pick):
+        if step.action != WAIT and self.pending is not None:
+            if step.action >= TO_OBJ:
+                self.pending[1] = True
+            else:
+                self.queue.remove(self.pending)
+            self.pending = None
+
+        if step.action != WAIT or step.reward > 0 or pick:
+            self.queue.append([step, True])
+        elif self.prev_dispatch:
+            self.pending = [step, False]
+            self.queue.append(self.pending)
+        self.prev_dispatch = step.action >= TO_OBJ
+
+        out = []
+        while self.queue and self.queue[0][1]:
+            out.append(self.queue.popleft()[0])
+        return out
+
+
+def follow(path, poll_interval=0.05, idle_timeout=None):
+    """Follow a trial CSV as rows are appended, like `tail -f`
+
+    Args:
+        path (str): path of the CSV, whose first line is the header.
+        poll_interval (float): seconds to wait for new rows.
+        idle_timeout (float): stop after this many seconds without new
+                              rows. Follows forever if None.
+    Yields:
+        dict mapping column names to the string values of each row.
+    """
+    with open(path, "r", newline="") as f:
+        header = None
+        partial = ""
+        idle_since = time.monotonic()
+        while True:
+            line = f.readline()
+            if not line.endswith("\n"):
+                # Wait for the rest of a partially written line
+                partial += line
+                if (idle_timeout is not None
+                        and time.monotonic() - idle_since > idle_timeout):
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            line, partial = partial + line, ""
+            idle_since = time.monotonic()
+            values = next(csv.reader([line]))
+            if header is None:
+                header = values
+            else:
+                yield dict(zip(header, values))
+
+
+def replay(path, rows_per_second=None):
+    """Replay the rows of a finished trial CSV at a chosen speed
+
+    Args:
+        path (str): path of the CSV.
+        rows_per_second (float): replay rate. Rows are yielded as fast as
+                                 possible if None.
+    """
+    start = time.monotonic()
+    with open(path, "r", newline="") as f:
+        for idx, row in enumerate(csv.DictReader(f)):
+            if rows_per_second is not None:
+                delay = start + idx / rows_per_second - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            yield row
+
+
+def process_rows(rows, num_bins=None):
+    """Yield the cleaned transitions of a stream of trial rows"""
+    trial = LiveTrial(num_bins)
+    for row in rows:
+        yield from trial.push(row)
+    yield from trial.finish()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="Trial CSV")
+    parser.add_argument("--bins", type=int, default=None,
+                        help="Number of bins (continuous if unset)")
+    parser.add_argument("--replay", action="store_true",
+                        help="Replay a finished CSV instead of following it")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Rows per second when replaying")
+    parser.add_argument("--idle_timeout", type=float, default=None,
+                        help="Stop following after this many idle seconds")
+    opt = parser.parse_args()
+
+    if opt.replay:
+        rows = replay(opt.path, opt.rate)
+    else:
+        rows = follow(opt.path, idle_timeout=opt.idle_timeout)
+    for transition in process_rows(rows, opt.bins):
+        print(transition.state, transition.action, transition.angle,
+              transition.reward)
@@ -0,0 +1,117 @@
+"""Loader of the extracted RW4T trajectories"""
+
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from store import TrajectoryStore
+
+
+# `angles` holds continuous movement angles, and is None for discrete data
+Episode = namedtuple("Episode",
+                     ["participant", "trial", "states", "actions", "rewards",
+                      "angles"])
+Transitions = namedtuple("Transitions",
+                         ["states", "actions", "rewards", "next_states",
+                          "dones", "angles"])
+
+
+class RW4TDataset():
+    """Lazy view of the trajectories extracted by `extract.py`
+
+    Arrays are memory mapped (see `store.TrajectoryStore`), so opening
+    the dataset or accessing an episode does not read the whole files.
+
+    Args:
+        root (str): folder with the `continuous` and `discrete` stores.
+        mode (str): either "continuous" or "discrete".
+        mmap_mode (str): memory map mode passed to `np.load`. Use None to
+                         load arrays into memory.
+    """
+    def __init__(self, root=os.path.join("..", "dataset", "trajectories"),
+                 mode="discrete", mmap_mode='r'):
+        self.mode = mode
+        self.store = TrajectoryStore(os.path.join(root, mode), mmap_mode)
+        self._episode_idx = None
+
+    @property
+    def action_vocab(self):
+        """Name of each action code"""
+        return self.store["action_vocab"]
+
+    @property
+    def participants(self):
+        """Participant id of each episode"""
+        return self.store["episode_participants"]
+
+    @property
+    def trials(self):
+        """Trial number of each episode"""
+        return self.store["episode_trials"]
+
+    @property
+    def num_transitions(self):
+        return len(self.store["dones"])
+
+    def __len__(self):
+        return self.store.num_episodes
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("episode index out of range")
+        states, actions, rewards = self.store.episode(idx)
+        angles = self._angles(self.store.episode_slice(idx))
+        return Episode(str(self.participants[idx]), int(self.trials[idx]),
+                       states, actions, rewards, angles)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def episode(self, participant, trial):
+        """Get the episode of a participant's trial"""
+        if self._episode_idx is None:
+            self._episode_idx = {
+                (str(p), int(t)): idx
+                for idx, (p, t) in enumerate(zip(self.participants,
+                                                 self.trials))}
+        key = str(participant), int(trial)
+        if key not in self._episode_idx:
+            raise KeyError("No episode for participant {} trial {}"
+                           .format(*key))
+        return self[self._episode_idx[key]]
+
+    def sample(self, batch_size, rng=None):
+        """Sample a minibatch of (s, a, r, s', done) transitions
+
+        Transitions are drawn uniformly with replacement. The next state
+        of an episode's last transition is its own state.
+
+        Args:
+            batch_size (int): number of transitions.
+            rng (np.random.Generator): random generator, defaults to a
+                                       new `np.random.default_rng()`.
+        Returns:
+            `Transitions` of arrays with `batch_size` rows.
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        idxs = np.sort(rng.integers(0, self.num_transitions, batch_size))
+        return self.transitions(idxs)
+
+    def transitions(self, idxs):
+        """Get the transitions at the given (global) step indices"""
+        idxs = np.asarray(idxs)
+        dones = self.store["dones"][idxs]
+        next_idxs = np.where(dones == 1, idxs, idxs + 1)
+        states = self.store["states"]
+        return Transitions(states[idxs], self.store["actions"][idxs],
+                           self.store["rewards"][idxs], states[next_idxs],
+                           dones, self._angles(idxs))
+
+    def _angles(self, idxs):
+        if "angles" not in self.store:
+            return None
+        return self.store["angles"][idxs]
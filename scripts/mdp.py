@@ -0,0 +1,183 @@
+"""Integer state ids and empirical transition model of discrete RW4T data
+
+`StateIndexer` encodes the discrete states of `get_state(df, num_bins)`,
+(x, y, six kit flags, robot status), into int32 ids with a mixed radix,
+and decodes them back. `TransitionModel` accumulates the counts and
+reward sums of observed (state, action, next state) transitions in
+compressed sparse row (CSR) form, one row per (state, action) pair.
+"""
+
+import numpy as np
+
+from process import NUM_MEDICAL_KITS, ACTIONS, action_kinds
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+
+class StateIndexer():
+    """Mixed-radix encoding of discrete states into int32 ids
+
+    Args:
+        num_bins (int): number of bins of discrete positions.
+    """
+    def __init__(self, num_bins=10):
+        self.num_bins = num_bins
+        # Smallest value and number of values of each state dimension.
+        # Robot status ranges from -1 (idle) to the last kit.
+        self.low = np.array([0, 0] + [0] * NUM_MEDICAL_KITS + [-1])
+        self.radix = np.array([num_bins, num_bins] + [2] * NUM_MEDICAL_KITS
+                              + [NUM_MEDICAL_KITS + 1])
+        # Place value of each dimension, the last one varying fastest
+        self.place = np.cumprod(np.append(self.radix[1:], 1)[::-1])[::-1]
+        self.num_states = int(np.prod(self.radix))
+        assert self.num_states <= np.iinfo(np.int32).max, \
+            'Too many states for int32 ids'
+
+    def encode(self, states):
+        """Ids of an N x D array of discrete states
+
+        Raises:
+            ValueError if a state is out of range or not integral.
+        """
+        states = np.asarray(states)
+        digits = states.astype(np.int64) - self.low
+        if (states.shape[-1] != len(self.radix) or np.any(digits < 0)
+                or np.any(digits >= self.radix)
+                or not np.array_equal(digits + self.low, states)):
+            raise ValueError("States are not discrete states with {} bins"
+                             .format(self.num_bins))
+        return (digits @ self.place).astype(np.int32)
+
+    def decode(self, ids):
+        """States of an array of ids, as float rows like `get_state`"""
+        ids = np.asarray(ids, dtype=np.int64)[..., None]
+        return (ids // self.place % self.radix + self.low).astype(np.float64)
+
+
+class TransitionModel():
+    """Sparse empirical transition counts and reward sums
+
+    Transitions are accumulated with `add` (or `add_episode`), so new
+    trials can be added to an existing model. Entries are kept sorted by
+    (state, action, next state), which is their CSR order.
+
+    Args:
+        indexer (StateIndexer): encoding of the states.
+        num_actions (int): number of action codes.
+    """
+    def __init__(self, indexer, num_actions=len(ACTIONS)):
+        self.indexer = indexer
+        self.num_actions = num_actions
+        self.shape = (indexer.num_states * num_actions, indexer.num_states)
+        # Flat (row, next state) keys of the observed transitions
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.reward_sums = np.empty(0, dtype=np.float64)
+
+    def add(self, states, actions, rewards, next_states):
+        """Accumulate transitions, given as arrays of states or ids"""
+        keys = self._row(self._ids(states), action_kinds(np.asarray(actions)))
+        keys = keys * self.shape[1] + self._ids(next_states)
+
+        keys, inverse = np.unique(np.concatenate([self.keys, keys]),
+                                  return_inverse=True)
+        old, new = inverse[:len(self.keys)], inverse[len(self.keys):]
+        counts = np.bincount(old, self.counts, len(keys)) \
+            + np.bincount(new, minlength=len(keys))
+        reward_sums = np.bincount(old, self.reward_sums, len(keys)) \
+            + np.bincount(new, rewards, len(keys))
+        self.keys = keys
+        self.counts = np.round(counts).astype(np.int64)
+        self.reward_sums = reward_sums
+
+    def add_episode(self, states, actions, rewards, dones=None):
+        """Accumulate the transitions of cleaned trajectories
+
+        The last step of each episode (where `dones` is 1, or the last
+        step if `dones` is None) has no next state and is not counted.
+        """
+        last = np.zeros(len(states), dtype=bool)
+        if dones is None:
+            last[-1] = True
+        else:
+            last[np.asarray(dones) == 1] = True
+        steps = np.flatnonzero(~last)
+        self.add(states[steps], np.asarray(actions)[steps],
+                 np.asarray(rewards)[steps], states[steps + 1])
+
+    @property
+    def num_transitions(self):
+        return int(self.counts.sum())
+
+    def csr(self, values=None):
+        """CSR arrays (indptr, indices, data) of the model
+
+        Rows are (state, action) pairs, `state * num_actions + action`,
+        and columns are next states.
+
+        Args:
+            values (np.ndarray): data of each entry, defaults to counts.
+        """
+        rows = self.keys // self.shape[1]
+        indptr = np.zeros(self.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=self.shape[0]),
+                  out=indptr[1:])
+        indices = (self.keys % self.shape[1]).astype(np.int32)
+        return indptr, indices, self.counts if values is None else values
+
+    def probabilities(self):
+        """Empirical next state probabilities of each entry"""
+        rows = self.keys // self.shape[1]
+        totals = np.bincount(rows, self.counts)
+        return self.counts / totals[rows]
+
+    def mean_rewards(self):
+        """Mean reward of each entry"""
+        return self.reward_sums / self.counts
+
+    def to_scipy(self, values=None):
+        """`scipy.sparse.csr_matrix` of the model (see `csr`)"""
+        if sparse is None:
+            raise ImportError("scipy is needed for sparse matrices")
+        indptr, indices, data = self.csr(values)
+        return sparse.csr_matrix((data, indices, indptr), shape=self.shape)
+
+    def _ids(self, states):
+        states = np.asarray(states)
+        if states.ndim == 1:
+            return states.astype(np.int64)
+        return self.indexer.encode(states).astype(np.int64)
+
+    def _row(self, ids, actions):
+        if np.any(actions < 0) or np.any(actions >= self.num_actions):
+            raise ValueError("Unknown action codes")
+        return ids * self.num_actions + actions
+
+
+def build_model(dataset, indexer=None, model=None, chunk_size=1 << 22):
+    """Accumulate the transitions of a discrete `loader.RW4TDataset`
+
+    The memory-mapped steps of the whole store are added in chunks of
+    `chunk_size` steps, a single `add` unless the store is very large.
+
+    Args:
+        dataset (RW4TDataset): discrete trajectories.
+        indexer (StateIndexer): defaults to one for 10 bins.
+        model (TransitionModel): existing model to update, e.g. with the
+                                 trials of new participants.
+        chunk_size (int): number of steps added at a time.
+    """
+    if model is None:
+        model = TransitionModel(indexer or StateIndexer())
+    dones = dataset.store["dones"]
+    for start in range(0, len(dones), chunk_size):
+        # The last step of each episode has no next state
+        steps = start + np.flatnonzero(
+            np.asarray(dones[start:start + chunk_size]) != 1)
+        batch = dataset.transitions(steps)
+        model.add(batch.states, batch.actions, batch.rewards,
+                  batch.next_states)
+    return model
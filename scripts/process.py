@@ -3,7 +3,8 @@
 import os
 import numpy as np
 import pandas as pd
-from copy import deepcopy as copy
+
+from instrument import stage
 
 
 # Rescue World for Teams (RW4T) Configurations
@@ -19,21 +20,114 @@ MEDICAL_KIT_IDX = {
     }
 NUM_TRIALS = 5
 
+# Flattened grid offset of each medical kit, ordered by kit index
+MEDICAL_KIT_FLAT_IDX = np.array(
+    [x * SIDE_LEN + y
+     for (x, y), _ in sorted(MEDICAL_KIT_IDX.items(), key=lambda kit: kit[1])]
+    )
+
+
+def _nearest_kit_table():
+    """Index of the nearest medical kit (Manhattan) for each grid cell
+
+    Ties are broken in favour of the kit listed first in
+    `MEDICAL_KIT_IDX`.
+    """
+    kits = list(MEDICAL_KIT_IDX)
+    kit_x = np.array([x for x, _ in kits])
+    kit_y = np.array([y for _, y in kits])
+    x, y = np.indices([SIDE_LEN, SIDE_LEN])
+    distance = (np.abs(x[..., None] - kit_x)
+                + np.abs(y[..., None] - kit_y))
+    kit_idx = np.array([MEDICAL_KIT_IDX[kit] for kit in kits], dtype=np.int8)
+    return kit_idx[np.argmin(distance, axis=-1)]
+
+
+# Nearest medical kit of each grid cell, SIDE_LEN x SIDE_LEN
+NEAREST_KIT = _nearest_kit_table()
+
+
+###### Trial features #######
+
+class TrialFeatures():
+    """MDP features of a RW4T trial.
+
+    Each raw column of the trial is parsed at most once, on first use,
+    and cached. States, actions and rewards, continuous or for any
+    number of bins, are then derived from the cached columns.
+    """
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self._cache = {}
+
+    def _cached(self, key, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    @property
+    def rescue_status(self) -> np.ndarray:
+        """Medical kit status at each frame (see `get_rescue_status`)"""
+        return self._cached("rescue_status",
+                            lambda: get_rescue_status(self.df))
+
+    @property
+    def robot_status(self) -> np.ndarray:
+        """Robot status at each frame (see `get_robot_state`)"""
+        return self._cached("robot_status",
+                            lambda: get_robot_state(self.df))
+
+    def position(self, num_bins: int = None) -> np.ndarray:
+        """Continuous (or discrete) user position at each frame"""
+        continuous = self._cached("position", lambda: get_user_pos(self.df))
+        if num_bins is None:
+            return continuous
+        return self._cached(("position", num_bins),
+                            lambda: discretize_pos(continuous, num_bins))
+
+    def state(self, num_bins: int = None) -> np.ndarray:
+        """Continuous (or discrete) state sequence
+
+        A new array is returned on every call, so callers may modify it.
+        """
+        return np.concatenate([self.position(num_bins),
+                               self.rescue_status,
+                               self.robot_status.reshape([-1, 1])],
+                              axis=1)
+
+    def actions(self, num_bins: int = None) -> np.ndarray:
+        """Continuous (or discrete) action sequence"""
+        def compute():
+            states = self.state(num_bins)
+            if num_bins is None:
+                actions = get_2dcontinuous_actions(states)
+            else:
+                actions = get_2ddiscrete_actions(states)
+
+            actions = get_rescue_actions(self.df, states, actions)
+            return add_robot_moves(self.df, states, actions)
+
+        return self._cached(("actions", num_bins), compute).copy()
+
+    def rewards(self) -> np.ndarray:
+        """Get rewards from trajectories.
+
+        This function does not include rewards from secondary tasks,
+        as currently secondary tasks are not included into the
+        action space.
+        """
+        return self._cached("rewards",
+                            lambda: compute_rewards(self.df)).copy()
+
 
 ###### Get MDPs STATE #######
 
 def get_state(df: pd.DataFrame, num_bins:int=None) -> np.array:
     """Get continuous (or discrete) state sequence"""
-    rescue_status = get_rescue_status(df)
-    robot_status = get_robot_state(df).reshape( [-1, 1] )
-    if num_bins is None:
-        position = get_user_pos(df)
-    else:
-        position = get_discrete_user_pos(df, num_bins)
-
-    return np.concatenate([position, rescue_status, robot_status], axis=1)
+    return TrialFeatures(df).state(num_bins)
 
 
+@stage()
 def get_rescue_status(df: pd.DataFrame) -> np.ndarray:
     """Get medical kit status at each frame
     
@@ -50,29 +144,54 @@ def get_rescue_status(df: pd.DataFrame) -> np.ndarray:
         Each array entry is either 0 or 1, representing whether medical
         kit was delivered (see `LOCATION_KITS`)
     """
-    # Placeholder
-    medical_kits = np.zeros([len(df), NUM_MEDICAL_KITS])
-
-    # Function to convert a grid from R4WT to numeric np.ndarray
-    def grid2numpy_(grid):
-        grid = np.array(grid.split("_"), dtype=int)
-        grid.resize(SIDE_LEN, SIDE_LEN)
-        return grid
-        
-    grid_seq = df["GridRep"]
-    for frame, grid in grid_seq.iteritems():
-        grid = grid2numpy_(grid)
-        # Check where medical kits are located
-        x, y = np.where(grid == 9)
-        for coordinate in zip(x, y):
-            # Medical kit present at coordinate;
-            # Annotate that in its corresponding index
-            kit_idx = MEDICAL_KIT_IDX[coordinate]
-            medical_kits[frame][kit_idx] = 1
-
-    return medical_kits
+    # The grid only changes when a kit is delivered, so each distinct
+    # grid is decoded once and its kit cells are broadcast to the frames
+    frames, grids = _decode_unique_grids(df["GridRep"])
+    medical_kits = grids[:, MEDICAL_KIT_FLAT_IDX] == 9
+    return medical_kits[frames].astype(float)
+
+
+def decode_grids(grid_seq: pd.Series) -> np.ndarray:
+    """Decode a `GridRep` column into numeric grids
+
+    Args:
+        grid_seq (pd.Series): `GridRep` column of a RW4T trial.
+    Returns:
+        np.ndarray of shape N x (SIDE_LEN * SIDE_LEN) and dtype uint8,
+        where `N = len(grid_seq)`. Row `i` is the flattened grid of
+        frame `i`, so cell (x, y) is at column `x * SIDE_LEN + y`.
+    """
+    frames, grids = _decode_unique_grids(grid_seq)
+    return grids[frames]
 
 
+def _decode_unique_grids(grid_seq):
+    """Decode each distinct grid string of a `GridRep` column once
+
+    Returns:
+        Tuple (frames, grids), where `grids` holds one flattened
+        uint8 grid per distinct string and `frames[i]` is the row
+        of `grids` that corresponds to frame `i`.
+    """
+    frames, uniques = pd.factorize(np.asarray(grid_seq, dtype=object))
+    num_cells = SIDE_LEN * SIDE_LEN
+    width = 2 * num_cells - 1
+    raw = "".join(uniques).encode("ascii")
+    if len(raw) == width * len(uniques):
+        # Single digit cells: read digits straight from the raw bytes,
+        # skipping the underscore separators
+        raw = np.frombuffer(raw, dtype=np.uint8).reshape([-1, width])
+        if np.all(raw[:, 1::2] == ord("_")):
+            return frames, raw[:, ::2] - np.uint8(ord("0"))
+
+    grids = np.zeros([len(uniques), num_cells], dtype=np.uint8)
+    for idx, grid in enumerate(uniques):
+        grid = np.array(grid.split("_"), dtype=np.uint8)
+        grids[idx, :len(grid)] = grid[:num_cells]
+    return frames, grids
+
+
+@stage()
 def get_robot_state(df: pd.DataFrame) -> np.ndarray:
     """Get robot status at each frame
     
@@ -89,25 +208,22 @@ def get_robot_state(df: pd.DataFrame) -> np.ndarray:
         -1 to 5. -1 represents a Stopped robot, the rest represents
         locations of medical kits as defined in `MEDICAL_KIT_IDX`.
     """
-    def distance(x, y):
-        dx = np.abs(x[0] - y[0])
-        dy = np.abs(x[1] - y[1])
-        return dx + dy
-
-    # Update robot status in-place
-    robot_status = copy(df["RobotState"].values)
-
-    for idx, status in enumerate(robot_status):
-        if status == "Stopped":
-            robot_status[idx] = -1
-        else:
-            x, y = status.split("_")
-            coordinate = int(x), int(y)
-            nearest = min(MEDICAL_KIT_IDX, key=lambda x: distance(x, coordinate))
-            robot_status[idx] = MEDICAL_KIT_IDX[nearest]
-    return robot_status.astype(int)
-
-
+    # Few distinct statuses per trial: parse each one once and map the
+    # goal cell to its nearest medical kit through `NEAREST_KIT`
+    frames, uniques = pd.factorize(np.asarray(df["RobotState"], dtype=object))
+    stopped = uniques == "Stopped"
+    goals = np.array([status.split("_") for status in uniques[~stopped]],
+                     dtype=int).reshape([-1, 2])
+    # Every kit lies inside the grid, so clipping goals outside of it
+    # shifts all kit distances equally and keeps the nearest kit
+    goals = np.clip(goals, 0, SIDE_LEN - 1)
+
+    robot_status = np.full(len(uniques), -1, dtype=int)
+    robot_status[~stopped] = NEAREST_KIT[goals[:, 0], goals[:, 1]]
+    return robot_status[frames]
+
+
+@stage()
 def get_user_pos(df: pd.DataFrame) -> np.array:
     """Get user position at each frame
     
@@ -120,20 +236,23 @@ def get_user_pos(df: pd.DataFrame) -> np.array:
         np.array of shape N x 2, where `N = len(df)`, with values from
         0 to 80.
     """
-    # Process user location in-place
+    # Parse all positions at once as a flat list of Unity coordinates
     tmp = df["PlayerUnityPos"].values
+    coords = np.fromstring(" ".join(tmp).replace("_", " "), sep=" ")
+    coords = coords.reshape([len(df), 3])
     user_loc = np.zeros([len(df), 2])
-    for idx, loc in enumerate(tmp):
-        y, _, x = loc.split("_")
-        x = 12 - float(x)
-        y = float(y) + 4
-        user_loc[idx] = x, y
+    user_loc[:, 0] = 12 - coords[:, 2]
+    user_loc[:, 1] = coords[:, 0] + 4
 
     return user_loc
 
 
 def get_discrete_user_pos(df, num_bins):
-    positions = get_user_pos(df)
+    return discretize_pos(get_user_pos(df), num_bins)
+
+
+def discretize_pos(positions, num_bins):
+    """Bin continuous positions into a `num_bins` x `num_bins` grid"""
     bins = np.linspace(0, 80, num_bins + 1)
     x_coord = positions[:, 0]
     y_coord = positions[:, 1]
@@ -147,60 +266,98 @@ def get_discrete_user_pos(df, num_bins):
 
 #### MDPs ACTIONS
 
+# Action vocabulary: discrete movements, continuous movements (whose
+# angle is kept apart), rescue and robot actions. The code of an action
+# is its index in the vocabulary.
+ACTIONS = (("wait", "up", "right", "left", "down", "diagonal", "move",
+            "collect", "stop_robot")
+           + tuple("toObj" + str(kit) for kit in range(NUM_MEDICAL_KITS)))
+(WAIT, UP, RIGHT, LEFT, DOWN, DIAGONAL, MOVE,
+ COLLECT, STOP_ROBOT, TO_OBJ) = range(10)
+
+# Discrete actions are arrays of codes. Continuous actions are records
+# of a code (`kind`) and the angle of `MOVE` actions, NaN otherwise.
+ACTION_DTYPE = np.int8
+CONTINUOUS_ACTION_DTYPE = np.dtype([("kind", ACTION_DTYPE),
+                                    ("angle", np.float64)])
+
+# Code of each discrete step (dx, dy), offset by one; -1 if invalid
+STEP_ACTIONS = np.full([3, 3], -1, dtype=ACTION_DTYPE)
+STEP_ACTIONS[1, 0] = UP
+STEP_ACTIONS[2, 1] = RIGHT
+STEP_ACTIONS[0, 1] = LEFT
+STEP_ACTIONS[1, 2] = DOWN
+STEP_ACTIONS[1, 1] = WAIT
+STEP_ACTIONS[0, 2] = DIAGONAL
+STEP_ACTIONS[2, 0] = DIAGONAL
+
+
+def action_kinds(actions):
+    """Action codes of discrete or continuous actions"""
+    if actions.dtype.names:
+        return actions["kind"]
+    return actions
 
-def get_actions(df, num_bins = None):
-    states = get_state(df, num_bins)
-    if num_bins is None:
-        actions = get_2dcontinuous_actions(states)
-    else:
-        actions = get_2ddiscrete_actions(states)
-        
-    actions = get_rescue_actions(df, states, actions)
-    actions = add_robot_moves(df, states, actions)
 
+def make_actions(codes, dtype):
+    """Build an action array of `dtype` from action codes"""
+    actions = np.zeros(len(codes), dtype=dtype)
+    set_actions(actions, slice(None), codes)
     return actions
 
 
+def set_actions(actions, idxs, codes):
+    """Set the actions at `idxs` to non movement `codes` in-place"""
+    if actions.dtype.names:
+        actions["kind"][idxs] = codes
+        actions["angle"][idxs] = np.nan
+    else:
+        actions[idxs] = codes
+
+
+def is_robot_dispatch(codes):
+    """Mask of action codes that send the robot to an object"""
+    return codes >= TO_OBJ
+
+
+def get_actions(df, num_bins = None):
+    return TrialFeatures(df).actions(num_bins)
+
+
+@stage()
 def get_2dcontinuous_actions(states):
     positions = states[:, :2]
     prev_pos = positions[:-1]
     next_pos = positions[1:]
     res = next_pos - prev_pos
     dx, dy = res[:,0], res[:, 1]
-    angle = np.arctan2(dy, dx)
-    wait_idx = np.where(np.abs(dx) + np.abs(dy) == 0)
-    angle = angle.astype(object)
-    angle[wait_idx] = "wait"
-    angle = np.insert(angle, -1, "wait")
-    
-    return angle
 
-def get_2ddiscrete_actions(states):
-    """"""
+    # Last action is a wait
+    actions = make_actions(np.full(len(positions), WAIT), CONTINUOUS_ACTION_DTYPE)
+    moves = np.flatnonzero(np.abs(dx) + np.abs(dy) != 0)
+    actions["kind"][moves] = MOVE
+    actions["angle"][moves] = np.arctan2(dy[moves], dx[moves])
 
-    positions = states[:, :2]
-    prev_pos = positions[:-1]
-    next_pos = positions[1:]
+    return actions
 
-    res = next_pos - prev_pos
-    steps = {(0,-1): 'up',
-             (1,0): 'right',
-             (-1,0): 'left',
-             (0,1): 'down',
-             (0,0): 'wait',
-             (-1,1): 'diagonal',
-             (1,-1): 'diagonal'
-            }
-    
-    actions = np.zeros(len(positions)).astype(str)
-    for idx, dx in enumerate(res):
-        actions[idx] = steps[tuple(dx)]
+@stage()
+def get_2ddiscrete_actions(states):
+    """Get discrete movement action codes from discrete states"""
+
+    positions = states[:, :2].astype(int)
+    res = positions[1:] - positions[:-1]
 
-    # Annotate last action
-    actions[-1] = 'wait'
+    if np.any(np.abs(res) > 1):
+        raise ValueError("Unexpected discrete step")
+    # Last action is a wait
+    actions = np.full(len(positions), WAIT, dtype=ACTION_DTYPE)
+    actions[:-1] = STEP_ACTIONS[res[:, 0] + 1, res[:, 1] + 1]
+    if np.any(actions < 0):
+        raise ValueError("Unexpected discrete step")
 
     return actions
 
+@stage()
 def get_rescue_actions(df, state, actions):
     picks = np.where(df['ButtonsClicked'] == 'CollectButton')[0] - 1
 
@@ -208,10 +365,11 @@ def get_rescue_actions(df, state, actions):
     idxs = np.where(np.any(rescue_status [1:] != rescue_status[:-1], axis=1)) 
     
     idxs = np.intersect1d(idxs, picks)
-    actions[idxs] = 'collect'
+    set_actions(actions, idxs, COLLECT)
     return actions
 
 
+@stage()
 def add_robot_moves(df, state, actions):
     """Check change of robot's state:
     If it was idle, it can only go to an active state,
@@ -229,25 +387,26 @@ def add_robot_moves(df, state, actions):
     move_click = np.where(button_clicks == 'MoveButton')[0] - 1
     
     idxs = np.intersect1d(robot_state_dx, move_click)
-    for idx in idxs:
-        actions[idx] = 'toObj' + str(robot_state[idx+1])
+    # Only dispatches to a medical kit are robot moves
+    idxs = idxs[robot_state[idxs + 1] >= 0]
+    set_actions(actions, idxs, TO_OBJ + robot_state[idxs + 1])
 
     pause_click = np.where(button_clicks == 'PauseButton')[0] - 1
     idxs = np.intersect1d(robot_state_dx, pause_click)
-    actions[idxs] = 'stop_robot'
+    set_actions(actions, idxs, STOP_ROBOT)
     
     return actions   
 
 
 ###### GET MDPs REWARDS #######
 def get_rewards(df):
-    """Get rewards from trajectories.
+    """Get rewards from trajectories (see `TrialFeatures.rewards`)"""
+    return TrialFeatures(df).rewards()
 
-    This function does not include rewards from secondary tasks,
-    as currently secondary tasks are not included into the 
-    action space.
 
-    """
+@stage("get_rewards")
+def compute_rewards(df):
+    """Rewards of each frame of a trial (see `TrialFeatures.rewards`)"""
     human_distributed = df["PlayerNum"].values
     robot_distributed = df["RobotNum"].values
     in_danger = df["DangerView"].values
@@ -256,11 +415,10 @@ def get_rewards(df):
     rewards -= 10 * (in_danger == "active").astype(int)
     kit_distr = ((human_distributed[1:] - human_distributed[:-1]) == 1).astype(int)
     kit_distr = np.insert(kit_distr, 0, 0)
-    
+
     robot_distr = ((robot_distributed[1:] - robot_distributed[:-1]) == 1).astype(int)
     robot_distr = np.insert(robot_distr, 0, 0)
     rewards += 25 * (kit_distr)
     rewards += 25 * (robot_distr)
-
     return rewards
 
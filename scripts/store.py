@@ -0,0 +1,255 @@
+"""Memory-mappable storage of extracted trajectories
+
+A trajectory store is a folder of .npy files that can all be opened with
+`np.load(..., mmap_mode='r')` and `allow_pickle=False`:
+
+    states.npy               N x D states
+    actions.npy              N int16 action codes, see `action_vocab.npy`
+    action_vocab.npy         name of each action code
+    angles.npy               N movement angles, NaN for non-movement
+                             actions (continuous trajectories only)
+    rewards.npy              N rewards
+    dones.npy                N flags, 1 at the last step of each episode
+    episode_offsets.npy      E + 1 offsets; episode `i` is the slice
+                             `episode_offsets[i]:episode_offsets[i + 1]`
+    episode_participants.npy E participant ids
+    episode_trials.npy       E trial numbers
+"""
+
+import os
+import shutil
+
+import numpy as np
+
+from process import ACTIONS
+
+
+def encode_actions(actions):
+    """Split an action array into codes and movement angles
+
+    Args:
+        actions (np.ndarray): discrete action codes or continuous action
+                              records (see `process.CONTINUOUS_ACTION_DTYPE`).
+    Returns:
+        Tuple (codes, angles). `angles` holds the angle of each
+        continuous movement and NaN elsewhere, or is None for discrete
+        actions.
+    """
+    if actions.dtype.names:
+        return actions["kind"].astype(np.int16), actions["angle"]
+    return actions.astype(np.int16), None
+
+
+def decode_actions(codes, vocab=ACTIONS, angles=None):
+    """Get readable actions: names, or float angles for movements"""
+    actions = np.asarray(vocab)[codes]
+    if angles is None:
+        return actions
+    actions = actions.astype(object)
+    moves = ~np.isnan(angles)
+    actions[moves] = angles[moves]
+    return actions
+
+
+def save_trajectories(path, states, actions, rewards, dones,
+                      participants, trials):
+    """Save concatenated episodes as a trajectory store
+
+    Args:
+        path (str): folder of the store.
+        states, actions, rewards, dones (np.ndarray): concatenated
+            episodes, as produced by `extract.py`. Each episode ends
+            at a step where `dones` is 1.
+        participants, trials (list): participant id and trial number of
+            each episode, in order.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    ends = np.flatnonzero(dones) + 1
+    assert len(ends) == len(participants) == len(trials), \
+        'Expected one participant and trial per episode'
+    offsets = np.concatenate([[0], ends]).astype(np.int64)
+
+    codes, angles = encode_actions(actions)
+    arrays = {
+        "states": states,
+        "actions": codes,
+        "action_vocab": np.array(ACTIONS),
+        "rewards": rewards,
+        "dones": dones,
+        "episode_offsets": offsets,
+        "episode_participants": np.array(participants, dtype=str),
+        "episode_trials": np.array(trials, dtype=np.int64),
+        }
+    if angles is not None:
+        arrays["angles"] = angles
+
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name), array, allow_pickle=False)
+
+
+class TrajectoryWriter():
+    """Append episodes to a trajectory store one at a time
+
+    Steps are written to disk as they are appended, so memory use is
+    bounded by a single episode. Files are written to a temporary folder,
+    `<path>.tmp`, and only moved into the store once the writer is
+    closed, so a failed extraction never leaves a truncated store. When
+    leaving a `with` block, the writer is closed, or aborted if an
+    exception was raised.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+        self._files = {}
+        self.offsets = [0]
+        self.participants = []
+        self.trials = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def append(self, participant, trial, states, actions, rewards,
+               dones=None):
+        """Append an episode of a participant's trial"""
+        if dones is None:
+            dones = np.zeros(len(states), dtype=int)
+            dones[-1] = 1
+
+        codes, angles = encode_actions(actions)
+        arrays = {"states": states, "actions": codes, "rewards": rewards,
+                  "dones": dones}
+        if angles is not None:
+            arrays["angles"] = angles
+
+        for name, array in arrays.items():
+            if name not in self._files:
+                file = os.path.join(self.tmp_path, name + ".npy")
+                self._files[name] = _NpyAppender(file)
+            self._files[name].append(array)
+
+        self.offsets.append(self.offsets[-1] + len(states))
+        self.participants.append(participant)
+        self.trials.append(trial)
+
+    def close(self):
+        """Complete the store with the appended episodes"""
+        if not os.path.exists(self.tmp_path):
+            return
+        for appender in self._files.values():
+            appender.close()
+        self._files = {}
+
+        arrays = {
+            "action_vocab": np.array(ACTIONS),
+            "episode_offsets": np.array(self.offsets, dtype=np.int64),
+            "episode_participants": np.array(self.participants, dtype=str),
+            "episode_trials": np.array(self.trials, dtype=np.int64),
+            }
+        for name, array in arrays.items():
+            np.save(os.path.join(self.tmp_path, name), array,
+                    allow_pickle=False)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        for fname in os.listdir(self.tmp_path):
+            os.replace(os.path.join(self.tmp_path, fname),
+                       os.path.join(self.path, fname))
+        os.rmdir(self.tmp_path)
+
+    def abort(self):
+        """Discard the appended episodes, leaving the store unchanged"""
+        for appender in self._files.values():
+            appender.f.close()
+        self._files = {}
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+class _NpyAppender():
+    """Append rows to a .npy file of unknown final length
+
+    A fixed size header is reserved when the file is created, and
+    rewritten with the final shape on close.
+    """
+    HEADER_LEN = 256
+
+    def __init__(self, file):
+        self.f = open(file, "wb")
+        self.f.write(b" " * self.HEADER_LEN)
+        self.dtype = None
+        self.row_shape = ()
+        self.rows = 0
+
+    def append(self, array):
+        array = np.asarray(array)
+        if self.dtype is None:
+            self.dtype = array.dtype
+            self.row_shape = array.shape[1:]
+        assert array.shape[1:] == self.row_shape, 'Inconsistent row shape'
+        self.f.write(np.ascontiguousarray(array, dtype=self.dtype).tobytes())
+        self.rows += len(array)
+
+    def close(self):
+        if self.f.closed:
+            return
+        dtype = np.dtype(float) if self.dtype is None else self.dtype
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}" \
+            .format(np.lib.format.dtype_to_descr(dtype),
+                    (self.rows,) + self.row_shape)
+        # Magic string, version 1.0 and header length take 10 bytes
+        header = header.ljust(self.HEADER_LEN - 11) + "\n"
+        assert len(header) == self.HEADER_LEN - 10, 'Header too long'
+
+        self.f.seek(0)
+        self.f.write(np.lib.format.magic(1, 0))
+        self.f.write(np.uint16(len(header)).tobytes())
+        self.f.write(header.encode("latin1"))
+        self.f.close()
+
+
+class TrajectoryStore():
+    """Memory-mapped trajectory store (see module docstring)
+
+    Arrays are opened lazily, as read-only memory maps by default, so
+    slicing an episode only reads that episode from disk.
+    """
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        self._arrays = {}
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            file = os.path.join(self.path, name + ".npy")
+            self._arrays[name] = np.load(file, mmap_mode=self.mmap_mode,
+                                         allow_pickle=False)
+        return self._arrays[name]
+
+    def __contains__(self, name):
+        return os.path.exists(os.path.join(self.path, name + ".npy"))
+
+    @property
+    def num_episodes(self):
+        return len(self["episode_offsets"]) - 1
+
+    def episode_slice(self, idx):
+        """Slice of the steps of episode `idx`"""
+        offsets = self["episode_offsets"]
+        return slice(int(offsets[idx]), int(offsets[idx + 1]))
+
+    def episode(self, idx):
+        """(states, actions, rewards) views of episode `idx`"""
+        steps = self.episode_slice(idx)
+        return self["states"][steps], self["actions"][steps], \
+            self["rewards"][steps]
@@ -0,0 +1,221 @@
+"""Synthetic RW4T trials, for benchmarks and offline development
+
+Trials follow the format of the Unity DataLog CSVs read by `process.py`:
+the player walks between grid cells one axis at a time, collects medical
+kits, sends the robot to kits, pauses it, and enters dangerous areas, at
+configurable rates.
+
+Usage: python synth.py --out ../dataset/synthetic --participants 4 --rows 5000
+"""
+
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from process import SIDE_LEN, MEDICAL_KIT_IDX, MEDICAL_KIT_FLAT_IDX
+from extract import TRIALS, trial_file
+
+
+# Side of a grid cell in positions of `get_user_pos`
+CELL_LEN = 80 / SIDE_LEN
+
+
+def generate_trial(num_rows, seed=None, collect_rate=0.5, dispatch_rate=0.005,
+                   pause_rate=0.002, danger_rate=0.002, speed=0.4,
+                   robot_frames=150, wait_frames=20, danger_frames=30,
+                   respawn_frames=None, obstacle_rate=0.2, fps=30,
+                   start_time=None):
+    """Generate a synthetic trial
+
+    Args:
+        num_rows (int): number of frames.
+        seed (int): seed of the random generator.
+        collect_rate (float): probability of collecting a kit in each
+                              frame spent on its cell.
+        dispatch_rate (float): probability of sending the idle robot to a
+                               remaining kit in each frame.
+        pause_rate (float): probability of pausing the busy robot in each
+                            frame.
+        danger_rate (float): probability of entering a dangerous area in
+                             each frame.
+        speed (float): player speed, in positions per frame. It must stay
+                       below `CELL_LEN`, so the player crosses at most one
+                       cell per frame.
+        robot_frames (int): mean number of frames the robot takes to pick
+                            a kit.
+        wait_frames (int): mean number of frames the player stays on a
+                           cell once there.
+        danger_frames (int): mean number of frames spent in a dangerous
+                             area.
+        respawn_frames (int): mean number of frames before a rescued kit
+                              reappears, so long trials keep rescuing.
+                              Kits do not reappear if None.
+        obstacle_rate (float): fraction of cells with obstacles.
+        fps (float): frame rate of the `Timestamp` column.
+        start_time (np.datetime64): time of the first frame. Without it,
+                                    there is no `Timestamp` column.
+    Returns:
+        pd.DataFrame with the columns of a Unity DataLog CSV.
+    """
+    assert 0 < speed < CELL_LEN, 'The player must cross one cell at a time'
+    rng = np.random.default_rng(seed)
+    kit_cells = [cell for cell, _ in sorted(MEDICAL_KIT_IDX.items(),
+                                            key=lambda kit: kit[1])]
+
+    grid = (rng.random(SIDE_LEN * SIDE_LEN) < obstacle_rate).astype(int)
+    grid[MEDICAL_KIT_FLAT_IDX] = 9
+    grid_rep = "_".join(map(str, grid))
+
+    cell = rng.integers(0, SIDE_LEN, 2)
+    pos = (cell + 0.5) * CELL_LEN
+    target = rng.integers(0, SIDE_LEN, 2)
+    robot = "Stopped"
+    robot_kit = None
+    player_num = robot_num = 0
+    danger = False
+    waiting = 0
+
+    columns = {name: [] for name in ("GridRep", "RobotState",
+                                     "PlayerUnityPos", "ButtonsClicked",
+                                     "PlayerNum", "RobotNum", "DangerView")}
+    for _ in range(num_rows):
+        click = ""
+        remaining = [kit for kit, (x, y) in enumerate(kit_cells)
+                     if grid[x * SIDE_LEN + y] == 9 and kit != robot_kit]
+
+        # Walk towards the target cell along one axis at a time, then
+        # stay there for a while
+        goal = (target + 0.5) * CELL_LEN
+        if waiting > 0:
+            waiting -= 1
+        elif np.all(np.abs(goal - pos) < 1e-9):
+            # Head to a remaining kit or wander to a random cell
+            if remaining and rng.random() < 0.5:
+                target = np.array(kit_cells[rng.choice(remaining)])
+            else:
+                target = rng.integers(0, SIDE_LEN, 2)
+        else:
+            axis = 0 if abs(goal[0] - pos[0]) > 1e-9 else 1
+            pos[axis] += np.clip(goal[axis] - pos[axis], -speed, speed)
+            if np.all(np.abs(goal - pos) < 1e-9):
+                waiting = rng.geometric(1 / wait_frames)
+        cell = np.minimum((pos // CELL_LEN).astype(int), SIDE_LEN - 1)
+
+        flat = cell[0] * SIDE_LEN + cell[1]
+        if grid[flat] == 9 and rng.random() < collect_rate:
+            click = "CollectButton"
+            grid[flat] = 0
+            grid_rep = "_".join(map(str, grid))
+            player_num += 1
+        elif robot_kit is None and remaining and rng.random() < dispatch_rate:
+            click = "MoveButton"
+            robot_kit = rng.choice(remaining)
+            x, y = kit_cells[robot_kit]
+            robot = "{}_{}".format(x, y)
+        elif robot_kit is not None and rng.random() < pause_rate:
+            click = "PauseButton"
+            robot = "Stopped"
+            robot_kit = None
+        elif robot_kit is not None and rng.random() < 1 / robot_frames:
+            # The robot picks its kit
+            x, y = kit_cells[robot_kit]
+            if grid[x * SIDE_LEN + y] == 9:
+                grid[x * SIDE_LEN + y] = 0
+                grid_rep = "_".join(map(str, grid))
+                robot_num += 1
+            robot = "Stopped"
+            robot_kit = None
+
+        if respawn_frames is not None and rng.random() < 1 / respawn_frames:
+            # A rescued kit reappears
+            rescued = [kit for kit, (x, y) in enumerate(kit_cells)
+                       if grid[x * SIDE_LEN + y] != 9]
+            if rescued:
+                x, y = kit_cells[rng.choice(rescued)]
+                grid[x * SIDE_LEN + y] = 9
+                grid_rep = "_".join(map(str, grid))
+
+        if rng.random() < (1 / danger_frames if danger else danger_rate):
+            danger = not danger
+
+        columns["GridRep"].append(grid_rep)
+        columns["RobotState"].append(robot)
+        # Inverse of the transform of `get_user_pos`
+        columns["PlayerUnityPos"].append("{:.3f}_0.5_{:.3f}".format(
+            pos[1] - 4, 12 - pos[0]))
+        columns["ButtonsClicked"].append(click)
+        columns["PlayerNum"].append(player_num)
+        columns["RobotNum"].append(robot_num)
+        columns["DangerView"].append("active" if danger else "inactive")
+
+    df = pd.DataFrame(columns)
+    if start_time is not None:
+        times = np.datetime64(start_time, "us") + np.round(
+            np.arange(num_rows) * 1e6 / fps).astype("timedelta64[us]")
+        df.insert(0, "Timestamp",
+                  np.char.replace(np.datetime_as_string(times), "T", " "))
+    return df
+
+
+def write_dataset(parent, participants=4, num_rows=5000, seed=0,
+                  trials=TRIALS, start_time=None, **kwargs):
+    """Write synthetic trials in the folder layout of the raw dataset
+
+    Args:
+        parent (str): folder of the dataset. Each participant gets a
+                      sub-folder `P<i>` with a CSV per trial.
+        participants (int): number of participants.
+        num_rows (int): number of frames of each trial.
+        seed (int): seed of the whole dataset.
+        start_time (np.datetime64): time of the first frame of each
+                                    participant's first trial. Later
+                                    trials start a minute after the
+                                    previous one ends. Without it, there
+                                    is no `Timestamp` column.
+        kwargs: rates and other arguments of `generate_trial`.
+    Returns:
+        list of the written CSV paths.
+    """
+    files = []
+    seeds = np.random.SeedSequence(seed).spawn(participants * len(trials))
+    for idx in range(participants):
+        user_folder = "P{:02d}".format(idx + 1)
+        os.makedirs(os.path.join(parent, user_folder), exist_ok=True)
+        trial_start = start_time
+        for trial_idx, trial in enumerate(trials):
+            file = trial_file(parent, user_folder, trial)
+            trial_seed = seeds[idx * len(trials) + trial_idx]
+            df = generate_trial(num_rows, trial_seed, start_time=trial_start,
+                                **kwargs)
+            df.to_csv(file, index=False)
+            files.append(file)
+            if trial_start is not None:
+                trial_start = np.datetime64(df["Timestamp"].iloc[-1], "us") \
+                    + np.timedelta64(60, "s")
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", type=str,
+                        default=os.path.join("..", "dataset", "synthetic"),
+                        help="Folder of the synthetic dataset")
+    parser.add_argument("--participants", type=int, default=4,
+                        help="Number of participants")
+    parser.add_argument("--rows", type=int, default=5000,
+                        help="Number of frames of each trial")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--collect_rate", type=float, default=0.5,
+                        help="Probability of collecting a kit per frame on its cell")
+    parser.add_argument("--dispatch_rate", type=float, default=0.005,
+                        help="Probability of sending the idle robot per frame")
+    parser.add_argument("--pause_rate", type=float, default=0.002,
+                        help="Probability of pausing the busy robot per frame")
+    opt = parser.parse_args()
+
+    write_dataset(opt.out, opt.participants, opt.rows, opt.seed,
+                  collect_rate=opt.collect_rate,
+                  dispatch_rate=opt.dispatch_rate,
+                  pause_rate=opt.pause_rate)
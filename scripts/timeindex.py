@@ -0,0 +1,99 @@
+"""Time-sorted recordings with binary-search windowing
+
+Recordings (gaze samples from `gazelog.load_gaze` or `GazeData`, rows of
+the bioharness CSV) are sorted by time once, after which the rows
+between two times are found with `np.searchsorted` and returned as
+slices, without scanning or copying the recording.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class TimeIndex():
+    """Recording sorted by time
+
+    Args:
+        data (pd.DataFrame or np.ndarray): recording, either a DataFrame
+                                           or an array of records.
+        column (str): time column, of datetimes (or strings of them) or
+                      numbers (e.g. `system_time_stamp`).
+    """
+    def __init__(self, data, column="Timestamp"):
+        self.column = column
+        times = _to_times(np.asarray(data[column]))
+        if len(times) > 1 and not np.all(times[1:] >= times[:-1]):
+            order = np.argsort(times, kind="stable")
+            times = times[order]
+            data = data.iloc[order] if isinstance(data, pd.DataFrame) \
+                else data[order]
+        self.data = data
+        self.times = times
+
+    def __len__(self):
+        return len(self.times)
+
+    def bounds(self, start, end, closed=False):
+        """Row range [lo, hi) of the window between start and end
+
+        Args:
+            start, end: window limits, scalars or arrays of them.
+            closed (bool): whether rows at exactly `start` or `end` are in
+                           the window. By default they are not.
+        Returns:
+            lo, hi: row indices, of the shape of `start` and `end`.
+        """
+        start = self._query(start)
+        end = self._query(end)
+        lo = np.searchsorted(self.times, start,
+                             side="left" if closed else "right")
+        hi = np.searchsorted(self.times, end,
+                             side="right" if closed else "left")
+        return lo, np.maximum(lo, hi)
+
+    def locate(self, times, side="left"):
+        """Insertion points of times in the recording (`np.searchsorted`)"""
+        return np.searchsorted(self.times, self._query(times), side=side)
+
+    def window(self, start, end, closed=False):
+        """Rows between start and end, as a view of the recording"""
+        lo, hi = self.bounds(start, end, closed)
+        return self._rows(int(lo), int(hi))
+
+    def windows(self, starts, ends, closed=False):
+        """Rows of many windows, each a view of the recording
+
+        The windows are located with one `np.searchsorted` per limit
+        array, in O(W log N) for W windows over N rows.
+        """
+        lo, hi = self.bounds(starts, ends, closed)
+        return [self._rows(l, h) for l, h in zip(lo.tolist(), hi.tolist())]
+
+    def slice(self, start, end, closed=False):
+        """`TimeIndex` of the rows between start and end"""
+        lo, hi = self.bounds(start, end, closed)
+        index = TimeIndex.__new__(TimeIndex)
+        index.column = self.column
+        index.data = self._rows(int(lo), int(hi))
+        index.times = self.times[int(lo):int(hi)]
+        return index
+
+    def _rows(self, lo, hi):
+        if isinstance(self.data, pd.DataFrame):
+            return self.data.iloc[lo:hi]
+        return self.data[lo:hi]
+
+    def _query(self, times):
+        times = np.asarray(times)
+        if self.times.dtype.kind == "M":
+            times = _to_times(np.atleast_1d(times)).reshape(times.shape)
+        return times
+
+
+def _to_times(values):
+    """Numeric times unchanged, other times as `datetime64[us]`"""
+    if values.dtype.kind in "iuf":
+        return values
+    if values.dtype.kind != "M":
+        values = pd.to_datetime(values).to_numpy()
+    return values.astype("datetime64[us]")